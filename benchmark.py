@@ -0,0 +1,325 @@
+import os
+import time
+import random
+import resource
+import asyncio
+import tempfile
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+import typing
+import click
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import unused_port
+from downloader import ImageDownloader, FixedConcurrency, RetryPolicy, PARSERS
+
+
+RESOLUTIONS = (
+    '320x480', '640x480', '800x480', '800x600', '1024x768', '1024x1024',
+    '1152x864', '1280x720', '1280x800', '1280x960', '1280x1024', '1366x768',
+    '1400x1050', '1440x900', '1600x1200', '1680x1050', '1680x1200',
+    '1920x1080', '1920x1200', '1920x1440', '2560x1440', '3840x2160',
+)
+
+
+def make_page(designs: int, month: str = 'may', year: int = 2019,
+              base_url: str = 'https://files.smashing.media') -> bytes:
+    '''Create calendar page in markup of Smashing Magazine with given
+    number of designs, each available with and without calendar in
+    every resolution. Images are linked under given base url'''
+    parts = ['<html><head><title>Desktop Wallpaper Calendars</title></head>'
+             '<body><article>']
+    for design in range(designs):
+        slug = 'design-{}'.format(design)
+        parts.append(
+            '<h2 id="{0}">Design {1}</h2><figure><a href="https://www.'
+            'smashingmagazine.com/files/wallpapers/{2}-{3}/{0}/{2}-{3}-{0}-preview'
+            '.png"><img src="preview.png" alt="Design {1}"></a></figure>'
+            '<p>Designed by <a href="https://example.com">Someone</a>.</p>'
+            '<ul>'.format(slug, design, month, str(year)[2:])
+        )
+        for variant, title in (('cal', 'with calendar'), ('nocal', 'without calendar')):
+            links = ', '.join(
+                '<a href="{6}/wallpapers/{0}-{1}/{2}/'
+                '{3}/{0}-{1}-{2}-{3}-{4}.png" title="Design {5} - {4}">{4}</a>'
+                .format(month, str(year)[2:], slug, variant, resolution, design,
+                        base_url)
+                for resolution in RESOLUTIONS
+            )
+            parts.append('<li>{0}: {1}</li>'.format(title, links))
+        parts.append('</ul>')
+    parts.append('</article></body></html>')
+    return ''.join(parts).encode('utf-8')
+
+
+def measure(func: typing.Callable[[], typing.Any],
+            repeat: int) -> typing.Tuple[float, int]:
+    '''Return best time of given number of runs and peak traced memory'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+@click.group()
+def cli():
+    '''Micro-benchmarks for Smashing wallpapers downloader'''
+
+
+@cli.command()
+@click.option('-d', '--designs', type=int, default=2000, show_default=True,
+              help='Number of designs on synthetic page')
+@click.option('-r', '--resolution', default='1920x1080', show_default=True,
+              help='Resolution to look for')
+@click.option('-n', '--repeat', type=int, default=5, show_default=True,
+              help='Number of runs for each parser')
+def parse(designs, resolution, repeat):
+    '''Compare parsers of page for image links'''
+    content = make_page(designs)
+    print('Page size: {:.1f} MB'.format(len(content) / 2 ** 20))
+
+    results = {}
+    for parser in PARSERS:
+        image_downloader = ImageDownloader(resolution, parser)
+        results[parser] = image_downloader.get_image_links(content)
+        best, peak = measure(
+            lambda: image_downloader.get_image_links(content), repeat)
+        print('{0:>8}: {1:8.1f} ms, peak memory {2:8.1f} MB, {3} links'.format(
+            parser, best * 1000, peak / 2 ** 20, len(results[parser])))
+
+    if len({tuple(links) for links in results.values()}) != 1:
+        raise click.ClickException('Parsers returned different links')
+
+
+def serve_images(port: int, size: int) -> None:
+    '''Run server answering every request with image of given size'''
+    body = b'\x89PNG\r\n\x1a\n' + os.urandom(size - 8)
+
+    async def image(request):
+        return web.Response(body=body, content_type='image/png')
+
+    app = web.Application()
+    app.router.add_get('/{name}', image)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+async def legacy_fetch(session: aiohttp.ClientSession, link: str, path: str) -> None:
+    '''Write path used before: 1 KiB reads, each written by a separate
+    thread pool call, as aiofiles does'''
+    loop = asyncio.get_running_loop()
+    async with session.get(link) as response:
+        response.raise_for_status()
+        f = await loop.run_in_executor(None, open, path, 'wb')
+        try:
+            while True:
+                chunk = await response.content.read(1024)
+                if not chunk:
+                    break
+                await loop.run_in_executor(None, f.write, chunk)
+        finally:
+            await loop.run_in_executor(None, f.close)
+
+
+async def fetch_images(url: str, files: int, method: str,
+                       chunk_size: int, directory: str) -> None:
+    '''Download given number of images, five at a time'''
+    image_downloader = ImageDownloader('640x480', chunk_size=chunk_size)
+    semaphore = asyncio.Semaphore(5)
+
+    async def fetch(number):
+        link = '{0}/image-{1}.png'.format(url, number)
+        path = os.path.join(directory, 'image-{}.png'.format(number))
+        async with semaphore:
+            if method == 'legacy':
+                await legacy_fetch(session, link, path)
+            else:
+                await image_downloader.fetch_image(session, link, path)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[fetch(number) for number in range(files)])
+    image_downloader.close()
+
+
+async def wait_for_server(url: str, timeout: float = 10) -> None:
+    '''Wait until server starts accepting connections'''
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url + '/ping') as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+
+@cli.command()
+@click.option('-f', '--files', type=int, default=20, show_default=True,
+              help='Number of images to download')
+@click.option('-s', '--size', type=int, default=10, show_default=True,
+              help='Size of image in MB')
+@click.option('--chunk-size', type=int, default=1024, show_default=True,
+              help='Size of blocks for new write path, in KiB')
+def write(files, size, chunk_size):
+    '''Compare CPU time per MB of previous and current write path.
+
+    Server runs in separate process, so only CPU time of downloader
+    (including its I/O threads) is measured.
+    '''
+    port = unused_port()
+    server = multiprocessing.Process(
+        target=serve_images, args=(port, size * 2 ** 20), daemon=True)
+    server.start()
+    url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        asyncio.run(wait_for_server(url))
+        total = files * size
+        for method in ('legacy', 'current'):
+            with tempfile.TemporaryDirectory() as directory:
+                cpu, wall = time.process_time(), time.perf_counter()
+                asyncio.run(fetch_images(url, files, method, chunk_size * 1024, directory))
+                cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+            print('{0:>8}: {1:7.2f} ms CPU per MB, {2:8.1f} MB/s, {3} MB'.format(
+                method, cpu * 1000 / total, total / wall, total))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def serve_site(port: int, designs: int, size: int, latency: float,
+               bandwidth: typing.Optional[float], error_rate: float, seed: int) -> None:
+    '''Run stand-in of wallpaper site: calendar page with given number of
+    designs at /page and images of given size under /wallpapers/.
+
+    Every image response is delayed by latency seconds, sent no faster
+    than bandwidth bytes per second per connection and replaced by 503
+    with probability error_rate, drawn from generator with given seed.
+    '''
+    page = make_page(designs, base_url='http://127.0.0.1:{}'.format(port))
+    body = b'\x89PNG\r\n\x1a\n' + os.urandom(size - 8)
+    block = 64 * 1024
+    rng = random.Random(seed)
+
+    async def calendar(request):
+        return web.Response(body=page, content_type='text/html')
+
+    async def image(request):
+        if latency:
+            await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            return web.Response(status=503)
+        if bandwidth is None:
+            return web.Response(body=body, content_type='image/png')
+        response = web.StreamResponse(headers={
+            'Content-Type': 'image/png', 'Content-Length': str(len(body))})
+        await response.prepare(request)
+        for start in range(0, len(body), block):
+            await response.write(body[start:start + block])
+            await asyncio.sleep(min(block, len(body) - start) / bandwidth)
+        return response
+
+    app = web.Application()
+    app.router.add_get('/page', calendar)
+    app.router.add_get('/ping', calendar)
+    app.router.add_get('/wallpapers/{path:.+}', image)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def run_downloader(url: str, resolution: str, connections: int,
+                   retries: int) -> typing.Dict[str, float]:
+    '''Fetch calendar page, find image links and download them all into
+    temporary directory. Runs in fresh process, so that its CPU time and
+    peak RSS belong to one run only'''
+    image_downloader = ImageDownloader(
+        resolution, concurrency=FixedConcurrency(connections),
+        retry=RetryPolicy(retries + 1, base_delay=0.05))
+    cpu, wall = time.process_time(), time.perf_counter()
+
+    async def run(directory):
+        async with image_downloader.create_session() as session:
+            content = await image_downloader.fetch_content(session, url + '/page')
+            links = image_downloader.get_image_links(content)
+            await image_downloader.download_all(directory, links, session)
+        return len(links)
+
+    with tempfile.TemporaryDirectory() as directory:
+        links = asyncio.run(run(directory))
+    image_downloader.close()
+    report = image_downloader.metrics.get_report(image_downloader)
+    return {
+        'links': links,
+        'downloaded': image_downloader.stats['downloaded'],
+        'failed': image_downloader.stats['failed'],
+        'retries': image_downloader.stats['retries'],
+        'bytes': report['bytes'],
+        'wall': time.perf_counter() - wall,
+        'cpu': time.process_time() - cpu,
+        # Linux reports peak RSS in KiB
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+@cli.command()
+@click.option('-d', '--designs', type=int, default=25, show_default=True,
+              help='Number of designs on calendar page, two images each')
+@click.option('-s', '--size', type=int, default=512, show_default=True,
+              help='Size of image in KiB')
+@click.option('-c', '--connections', type=int, multiple=True,
+              help='Concurrency level to measure, can be given several times  '
+                   '[default: 1, 5, 20]')
+@click.option('--latency', type=float, default=0.0, show_default=True,
+              help='Delay before every image response, in ms')
+@click.option('--bandwidth', type=float,
+              help='Bandwidth cap of every connection, in MB/s')
+@click.option('--error-rate', type=click.FloatRange(0, 1), default=0.0,
+              show_default=True, help='Share of image requests answered with 503')
+@click.option('--retries', type=int, default=3, show_default=True,
+              help='Number of retries of failed request')
+@click.option('--seed', type=int, default=0, show_default=True,
+              help='Seed of generator of server errors')
+def site(designs, size, connections, latency, bandwidth, error_rate, retries, seed):
+    '''Download every image of synthetic calendar page from local server
+    at several concurrency levels.
+
+    Server runs in separate process; every level is measured in fresh
+    process, so CPU time and peak RSS are not mixed between levels.
+    '''
+    resolution = RESOLUTIONS[0]
+    port = unused_port()
+    server = multiprocessing.Process(
+        target=serve_site, daemon=True,
+        args=(port, designs, size * 1024, latency / 1000,
+              bandwidth * 2 ** 20 if bandwidth else None, error_rate, seed))
+    server.start()
+    url = 'http://127.0.0.1:{}'.format(port)
+    context = multiprocessing.get_context('spawn')
+    try:
+        asyncio.run(wait_for_server(url))
+        print('{0:>5} {1:>9} {2:>7} {3:>8} {4:>8} {5:>9} {6:>8} {7:>7}'.format(
+            'conns', 'files', 'failed', 'files/s', 'MB/s', 'CPU ms', 'RSS MB', 'retries'))
+        for level in connections or (1, 5, 20):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(
+                    run_downloader, url, resolution, level, retries).result()
+            print('{0:>5} {1:>4}/{2:<4} {3:>7} {4:>8.1f} {5:>8.1f} {6:>9.1f} '
+                  '{7:>8.1f} {8:>7}'.format(
+                      level, result['downloaded'], result['links'], result['failed'],
+                      result['downloaded'] / result['wall'],
+                      result['bytes'] / 2 ** 20 / result['wall'],
+                      result['cpu'] * 1000, result['rss'] / 2 ** 20, result['retries']))
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    cli()
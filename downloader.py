@@ -1,13 +1,49 @@
+from __future__ import annotations
+
 import os
 import re
+import sys
 import typing
 import calendar
-import asyncio
+import time
+import random
+import contextlib
+import shutil
+import collections
+import urllib.parse
 import click
-import requests
-from bs4 import BeautifulSoup
-import aiohttp
-import aiofiles
+
+# Heavy dependencies are imported by functions which need them, so that
+# --help and validation of arguments start fast
+if typing.TYPE_CHECKING:
+    import hashlib
+    import concurrent.futures
+    import aiohttp
+
+
+MIN_YEAR, MAX_YEAR = 2011, 2020
+RESOLUTION_PATTERN = r'^\d{3,4}x\d{3,4}$'
+FETCH_TIMEOUT = 5
+PART_SUFFIX = '.part'
+# Size of blocks in which image is read from network and written to disk
+CHUNK_SIZE = 1024 * 1024
+# Policies limiting number of image requests in flight, the first one is default
+CONCURRENCY_POLICIES = ('fixed', 'adaptive')
+# Page cache is revalidated after this number of days
+CACHE_TTL = 30
+# Page cache evicts least recently used pages above this size, in MB
+CACHE_SIZE = 64
+# Orders of downloading images, the first one is default. Images are
+# ordered by size within the window of scheduler queue
+ORDERS = ('page', 'smallest', 'largest')
+# Formats of archive output, the first one is default
+ARCHIVE_FORMATS = ('tar', 'zip')
+# Directory inside base directory for state kept between runs
+STATE_DIRECTORY = '.smashing'
+# Engines for parsing page for image links, the first one is default
+PARSERS = ('stream', 'soup')
+# Upper bounds of buckets of stage duration histograms, in seconds
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
 
 class Month:
@@ -43,16 +79,1463 @@ class Month:
             return calendar.month_name[int(self._month)]
 
 
+def is_resolution(text: str) -> bool:
+    '''Return whether text is resolution, like 1920x1080'''
+    return re.search(RESOLUTION_PATTERN, text) is not None
+
+
+class YearMonth(click.ParamType):
+    '''Click parameter type for month of the year in form YYYY-MM'''
+    name = 'YYYY-MM'
+
+    def convert(self, value, param, ctx) -> typing.Tuple[int, int]:
+        '''Convert user input into (year, month number) tuple'''
+        if isinstance(value, tuple):
+            return value
+        match = re.search(r'^(\d{4})-(\d{1,2})$', value)
+        if not match:
+            self.fail('{} is not in YYYY-MM format'.format(value), param, ctx)
+        year, month_number = int(match.group(1)), int(match.group(2))
+        if not MIN_YEAR <= year <= MAX_YEAR:
+            self.fail('Year {0} is not between {1} and {2}'.format(
+                year, MIN_YEAR, MAX_YEAR), param, ctx)
+        if not 1 <= month_number <= 12:
+            self.fail('Month {} is not valid'.format(month_number), param, ctx)
+        return year, month_number
+
+
+def iter_months(start: typing.Tuple[int, int],
+                end: typing.Tuple[int, int]) -> typing.Iterator[typing.Tuple[Month, int]]:
+    '''Yield (Month, year) pairs from start to end inclusive'''
+    year, month_number = start
+    while (year, month_number) <= end:
+        yield Month(str(month_number)), year
+        year, month_number = (year + 1, 1) if month_number == 12 \
+            else (year, month_number + 1)
+
+
+def parse_content_range(
+        value: str) -> typing.Optional[typing.Tuple[int, int, typing.Optional[int]]]:
+    '''Parse Content-Range header into (first byte, last byte, total size)'''
+    match = re.search(r'^bytes (\d+)-(\d+)/(\d+|\*)$', value.strip())
+    if not match:
+        return None
+    total = match.group(3)
+    return (int(match.group(1)), int(match.group(2)),
+            int(total) if total != '*' else None)
+
+
+class MonthReport(typing.NamedTuple):
+    '''Outcome of downloading images for one month of range'''
+    month: Month
+    year: int
+    found: int
+    downloaded: int
+    error: typing.Optional[str] = None
+
+
+class IncompleteDownloadError(Exception):
+    '''Raised when size of downloaded image differs from expected one'''
+
+
+class InvalidImageError(Exception):
+    '''Raised when downloaded content is not an image'''
+
+
+class CircuitOpenError(Exception):
+    '''Raised when requests to host are suspended by circuit breaker'''
+
+
+def describe_error(err: Exception) -> str:
+    '''Return human readable reason of failed request'''
+    import asyncio
+    import aiohttp
+    if isinstance(err, asyncio.TimeoutError):
+        return 'Connection timed out'
+    if isinstance(err, aiohttp.ClientResponseError):
+        return 'Error {}'.format(err.status)
+    if isinstance(err, aiohttp.ClientPayloadError):
+        return 'Connection closed before download completed'
+    if isinstance(err, aiohttp.ClientError):
+        return 'Unable to establish connection'
+    return str(err) or err.__class__.__name__
+
+
+def parse_retry_after(value: typing.Optional[str]) -> typing.Optional[float]:
+    '''Parse Retry-After header given in seconds or as HTTP date'''
+    import email.utils
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RetryPolicy:
+    '''Class to represent policy of retrying failed requests.
+
+    Delay before retry grows exponentially with full jitter. Delay asked
+    by server in Retry-After header of 429 and 503 responses is honoured,
+    as long as it is not longer than max_delay.
+    '''
+    RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+    def __init__(self, attempts: int = 4, base_delay: float = 0.5,
+                 max_delay: float = 60.0):
+        if attempts < 1:
+            raise ValueError('Number of attempts is not valid', attempts)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, err: Exception) -> bool:
+        '''Return whether request failed with given error is worth repeating'''
+        import asyncio
+        import aiohttp
+        if isinstance(err, aiohttp.ClientResponseError):
+            return err.status in self.RETRY_STATUSES
+        return isinstance(err, (asyncio.TimeoutError, aiohttp.ClientError,
+                                IncompleteDownloadError))
+
+    def get_delay(self, attempt: int, err: Exception) -> typing.Optional[float]:
+        '''Return delay before given attempt (counted from 1) after error,
+        or None if the request should not be repeated'''
+        import aiohttp
+        if attempt >= self.attempts or not self.is_retryable(err):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if isinstance(err, aiohttp.ClientResponseError) and err.status in (429, 503):
+            retry_after = parse_retry_after((err.headers or {}).get('Retry-After'))
+            if retry_after is not None:
+                if retry_after > self.max_delay:
+                    return None
+                delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    '''Class to represent circuit breaker of one host.
+
+    After failure_threshold consecutive failures the circuit opens and
+    requests fail immediately. When reset_timeout passes, one trial request
+    is let through: its success closes the circuit, its failure opens it
+    again.
+    '''
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        '''Return state of circuit: closed, open or half-open'''
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def check(self) -> bool:
+        '''Raise CircuitOpenError if request should not be made now, return
+        True if the request is trial one'''
+        state = self.state
+        if state == 'open' or state == 'half-open' and self._trial:
+            raise CircuitOpenError('Host is unavailable, requests are suspended')
+        if state == 'half-open':
+            self._trial = True
+            return True
+        return False
+
+    def abort_trial(self) -> None:
+        '''Let the next request be trial one, when trial request ended with
+        neither success nor failure, like cancelled one'''
+        self._trial = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+
+def parse_rate(value: str) -> typing.Optional[float]:
+    '''Parse rate like 500, 200K or 1.5M (binary multiples), return None
+    for no limit: empty value, 0 or none'''
+    value = value.strip().lower()
+    if value in ('', '0', 'none'):
+        return None
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([kmg]?)$', value)
+    if not match:
+        raise ValueError('Rate value is not valid', value)
+    return float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2) or ' ')
+
+
+class Rate(click.ParamType):
+    '''Parameter type for rates with optional K, M or G suffix'''
+    name = 'RATE'
+
+    def convert(self, value, param, ctx) -> typing.Optional[float]:
+        if value is None or isinstance(value, float):
+            return value
+        try:
+            return parse_rate(value)
+        except ValueError:
+            self.fail('{!r} is not a valid rate, example: 500K'.format(value), param, ctx)
+
+
+class TokenBucket:
+    '''Class to represent token bucket refilled with rate tokens per second
+    up to burst tokens.
+
+    Tokens are taken in advance: bucket may go into debt, and the caller
+    waits until the debt is repaid, so large amounts are allowed and
+    callers are served in order.
+    '''
+
+    def __init__(self, rate: typing.Optional[float], burst: typing.Optional[float] = None):
+        self.rate = None
+        self.burst = self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.configure(rate, burst)
+
+    def configure(self, rate: typing.Optional[float],
+                  burst: typing.Optional[float] = None) -> None:
+        '''Change rate and burst, None rate means no limit, default burst is
+        one second of rate'''
+        if rate is not None and rate <= 0 or burst is not None and burst < 0:
+            raise ValueError('Rate limit is not valid', rate)
+        self._refill()
+        unlimited = self.rate is None
+        self.rate = rate
+        self.burst = (rate if burst is None else burst) if rate is not None else 0.0
+        # Bucket which had no limit is full
+        self.tokens = self.burst if unlimited else min(self.tokens, self.burst)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        '''Take given amount of tokens, return seconds to wait for them'''
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    '''Class to represent limits of received bytes and requests per second,
+    both for all hosts together and for every host. Burst is number of
+    seconds of rate which may be used at once after idle time.
+
+    Limits can be changed while running: configure() is called on changes
+    of control file given to watch(), which is also reread on SIGHUP.
+    '''
+    # Names of limits, also keys of control file
+    LIMITS = ('limit-rate', 'host-limit-rate', 'limit-requests', 'host-limit-requests', 'burst')
+
+    def __init__(self, byte_rate: typing.Optional[float] = None,
+                 request_rate: typing.Optional[float] = None,
+                 host_byte_rate: typing.Optional[float] = None,
+                 host_request_rate: typing.Optional[float] = None,
+                 burst: float = 1.0):
+        self.bytes = TokenBucket(None)
+        self.requests = TokenBucket(None)
+        # Buckets of every host, limiter is passed to worker processes, so
+        # these are plain dictionaries
+        self.host_bytes = {}
+        self.host_requests = {}
+        self.control_path = None
+        self._mtime = None
+        self._watcher = None
+        self.configure(byte_rate, request_rate, host_byte_rate, host_request_rate, burst)
+
+    def _get_burst(self, rate: typing.Optional[float]) -> typing.Optional[float]:
+        return rate * self.burst if rate is not None else None
+
+    def configure(self, byte_rate: typing.Optional[float] = None,
+                  request_rate: typing.Optional[float] = None,
+                  host_byte_rate: typing.Optional[float] = None,
+                  host_request_rate: typing.Optional[float] = None,
+                  burst: float = 1.0) -> None:
+        '''Set limits, None means no limit'''
+        if burst < 0:
+            raise ValueError('Burst value is not valid', burst)
+        self.burst = burst
+        self.byte_rate, self.request_rate = byte_rate, request_rate
+        self.host_byte_rate, self.host_request_rate = host_byte_rate, host_request_rate
+        self.bytes.configure(byte_rate, self._get_burst(byte_rate))
+        self.requests.configure(request_rate, self._get_burst(request_rate))
+        for bucket in self.host_bytes.values():
+            bucket.configure(host_byte_rate, self._get_burst(host_byte_rate))
+        for bucket in self.host_requests.values():
+            bucket.configure(host_request_rate, self._get_burst(host_request_rate))
+
+    @property
+    def unlimited(self) -> bool:
+        return self.control_path is None and all(rate is None for rate in (
+            self.byte_rate, self.request_rate, self.host_byte_rate, self.host_request_rate))
+
+    async def _take(self, buckets: typing.Iterable[TokenBucket], amount: float) -> None:
+        import asyncio
+        if self.control_path is not None and self._watcher is None:
+            self._start_watcher()
+        delay = max(bucket.reserve(amount) for bucket in buckets)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _get_host_bucket(self, buckets: typing.Dict[str, TokenBucket], url: str,
+                         rate: typing.Optional[float]) -> TokenBucket:
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in buckets:
+            buckets[host] = TokenBucket(rate, self._get_burst(rate))
+        return buckets[host]
+
+    async def request(self, url: str) -> None:
+        '''Wait until request to given url is allowed'''
+        if not self.unlimited:
+            await self._take((self.requests, self._get_host_bucket(
+                self.host_requests, url, self.host_request_rate)), 1)
+
+    async def receive(self, url: str, amount: int) -> None:
+        '''Account given number of bytes received from url, wait until
+        receiving more is allowed'''
+        if not self.unlimited:
+            await self._take((self.bytes, self._get_host_bucket(
+                self.host_bytes, url, self.host_byte_rate)), amount)
+
+    def load(self, path: str) -> None:
+        '''Configure limits from control file of 'name = value' lines, names
+        are the ones of command line options. Missing names keep their values'''
+        values = {'limit-rate': self.byte_rate, 'limit-requests': self.request_rate,
+                  'host-limit-rate': self.host_byte_rate,
+                  'host-limit-requests': self.host_request_rate, 'burst': self.burst}
+        with open(path) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                name, _, value = (part.strip() for part in line.partition('='))
+                if name not in self.LIMITS:
+                    raise ValueError('Unknown limit', name)
+                values[name] = float(value) if name == 'burst' else parse_rate(value)
+        self.configure(values['limit-rate'], values['limit-requests'],
+                       values['host-limit-rate'], values['host-limit-requests'],
+                       values['burst'])
+
+    def watch(self, path: str) -> None:
+        '''Apply limits from control file now and whenever it changes'''
+        self.control_path = path
+        self.reload()
+
+    def reload(self) -> None:
+        '''Apply limits from control file, keep current ones if it is broken'''
+        try:
+            self._mtime = os.path.getmtime(self.control_path)
+            self.load(self.control_path)
+        except (OSError, ValueError) as err:
+            print('Unable to apply rate limits from {0}: {1}'.format(self.control_path, err))
+
+    def _start_watcher(self) -> None:
+        # Watcher is bound to running loop, so it is started lazily
+        import asyncio
+        import signal
+        loop = asyncio.get_running_loop()
+        self._watcher = loop.create_task(self._watch())
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        except (AttributeError, NotImplementedError, RuntimeError):
+            # No SIGHUP on Windows, no signal handlers outside main thread
+            pass
+
+    async def _watch(self, interval: float = 1.0) -> None:
+        import asyncio
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    mtime = os.path.getmtime(self.control_path)
+                except OSError:
+                    continue
+                if mtime != self._mtime:
+                    self.reload()
+        finally:
+            self._watcher = None
+
+
+# Magic bytes at the beginning of image files
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+# Number of first bytes enough to recognize image type
+SIGNATURE_SIZE = 12
+
+
+def sniff_image_type(head: bytes) -> typing.Optional[str]:
+    '''Return type of image by its first bytes, None if it is not an image'''
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def hash_part_file(path: str, length: int, digest: 'hashlib._Hash') -> bytes:
+    '''Feed first length bytes of part file to digest, return first bytes
+    of file for recognizing image type'''
+    with open(path, 'rb') as f:
+        head = f.read(SIGNATURE_SIZE)
+        f.seek(0)
+        remaining = length
+        while remaining:
+            block = f.read(min(remaining, CHUNK_SIZE))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return head
+
+
+def write_block(f: typing.BinaryIO, digest: 'hashlib._Hash', block: bytes) -> int:
+    '''Write block to file and feed it to digest, return its length'''
+    digest.update(block)
+    return f.write(block)
+
+
+def open_part_file(path: str, offset: int) -> typing.BinaryIO:
+    '''Open part file for writing from offset'''
+    f = open(path, 'r+b' if offset else 'wb')
+    try:
+        f.seek(offset)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+class DownloadResult(typing.NamedTuple):
+    '''Outcome of downloading one image. Status is one of downloaded,
+    deduplicated (downloaded, but in content store already), unchanged
+    (skipped in sync mode) and failed. Path is name of archive entry in
+    archive mode. Result is true unless download failed'''
+    url: str
+    path: str
+    status: str
+    bytes: int = 0
+    duration: float = 0.0
+    error: typing.Optional[str] = None
+
+    def __bool__(self) -> bool:
+        return self.status != 'failed'
+
+
+class ImageResponse(typing.NamedTuple):
+    '''Details of response to image request'''
+    status: int
+    size: typing.Optional[int] = None
+    etag: typing.Optional[str] = None
+    last_modified: typing.Optional[str] = None
+    received: int = 0
+    sha256: typing.Optional[str] = None
+
+
+class FixedConcurrency:
+    '''Class to represent policy with constant limit of requests in flight.'''
+
+    def __init__(self, limit: int = 5):
+        if limit < 1:
+            raise ValueError('Concurrency limit is not valid', limit)
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = None
+
+    async def acquire(self) -> float:
+        '''Wait for free slot, return time when request is started'''
+        import asyncio
+        if self._condition is None:
+            # Condition is bound to running loop, so it is created lazily
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        return time.monotonic()
+
+    async def release(self, started: float, received: int = 0,
+                      congested: bool = False) -> None:
+        '''Free slot taken at started time. Congested is set when server
+        timed out or answered with 429 or 5xx'''
+        async with self._condition:
+            self.in_flight -= 1
+            self.update(started, received, congested)
+            if self.in_flight < self.limit:
+                self._condition.notify(self.limit - self.in_flight)
+
+    def update(self, started: float, received: int, congested: bool) -> None:
+        '''Adjust limit after completed request'''
+
+
+class AdaptiveConcurrency(FixedConcurrency):
+    '''Class to represent AIMD policy for limit of requests in flight.
+
+    Requests are measured in windows about as long as the limit. The limit
+    is increased by one while throughput of window grows and its mean
+    latency stays within latency_tolerance of the best one, and halved on
+    congestion. Requests started before the last decrease are not taken
+    into account, so one burst of errors halves the limit only once.
+    '''
+
+    def __init__(self, limit: int = 5, minimum: int = 1, maximum: int = 64,
+                 latency_tolerance: float = 1.5):
+        super().__init__(limit)
+        if not 1 <= minimum <= limit <= maximum:
+            raise ValueError('Concurrency limits are not valid', (minimum, limit, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self._base_latency = None
+        self._throughput = 0.0
+        self._decreased_at = float('-inf')
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._window_received = 0
+        self._window_latency = 0.0
+
+    def update(self, started: float, received: int, congested: bool) -> None:
+        if started < self._decreased_at:
+            return
+        now = time.monotonic()
+        if congested:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._decreased_at = now
+            self._throughput = 0.0
+            self._reset_window()
+            return
+
+        self._window_count += 1
+        self._window_received += received
+        self._window_latency += now - started
+        if self._window_count < max(self.limit, 4):
+            return
+
+        latency = self._window_latency / self._window_count
+        throughput = self._window_received / max(now - self._window_start, 1e-6)
+        if self._base_latency is None or latency < self._base_latency:
+            self._base_latency = latency
+        if throughput >= self._throughput and \
+                latency <= self._base_latency * self.latency_tolerance:
+            self.limit = min(self.maximum, self.limit + 1)
+        self._throughput = throughput
+        self._reset_window()
+
+
+class ManifestEntry(typing.NamedTuple):
+    '''Record of downloaded image'''
+    url: str
+    path: str
+    size: int
+    etag: typing.Optional[str] = None
+    last_modified: typing.Optional[str] = None
+    sha256: typing.Optional[str] = None
+
+
+class Manifest:
+    '''Class to represent persistent record of downloaded images.
+
+    Entries are kept in SQLite database and keyed by image url.
+    '''
+
+    def __init__(self, path: str):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'url TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, '
+                'etag TEXT, last_modified TEXT, sha256 TEXT)'
+            )
+            columns = [row[1] for row in self._connection.execute(
+                'PRAGMA table_info(images)')]
+            if 'sha256' not in columns:
+                # Manifest created before digests were recorded
+                self._connection.execute('ALTER TABLE images ADD COLUMN sha256 TEXT')
+
+    def get(self, url: str) -> typing.Optional[ManifestEntry]:
+        '''Return entry for given image url, if there is one'''
+        row = self._connection.execute(
+            'SELECT url, path, size, etag, last_modified, sha256 '
+            'FROM images WHERE url = ?',
+            (url,)
+        ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def record(self, entry: ManifestEntry) -> None:
+        '''Add or replace entry for image'''
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO images '
+                '(url, path, size, etag, last_modified, sha256) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                entry
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def reflink_file(source: str, target: str) -> None:
+    '''Create copy-on-write clone of file, where filesystem supports it'''
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError('Reflinks are not supported')
+    # FICLONE request of Linux ioctl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+
+
+def link_file(source: str, target: str) -> None:
+    '''Replace target with hardlink to source, falling back to reflink and
+    then to plain copy where hardlinks can't be made'''
+    temp_path = target + '.link'
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        try:
+            reflink_file(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)
+
+
+class ContentStore:
+    '''Class to represent content-addressed store of images.
+
+    Every distinct image is kept once, under its SHA-256 digest, and files
+    in month directories are hardlinks to it. Note that changing one of
+    such files changes all of them.
+    '''
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_blob_path(self, digest: str) -> str:
+        '''Return path of image with given digest in store'''
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def contains(self, digest: typing.Optional[str]) -> bool:
+        return bool(digest) and os.path.isfile(self.get_blob_path(digest))
+
+    def commit(self, part_path: str, digest: str, image_path: str) -> bool:
+        '''Move downloaded part file into store and link image path to it.
+        If the content is stored already, part file is dropped instead of
+        being written to store. Return whether content was stored before'''
+        blob_path = self.get_blob_path(digest)
+        stored = os.path.isfile(blob_path)
+        if stored:
+            os.remove(part_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.move(part_path, blob_path)
+        link_file(blob_path, image_path)
+        return stored
+
+    def restore(self, digest: str, image_path: str) -> None:
+        '''Link image path to stored content'''
+        link_file(self.get_blob_path(digest), image_path)
+
+
+class TarArchiveWriter:
+    '''Class to write tar archive to stream entry by entry, size of entry
+    must be known before its data'''
+    requires_size = True
+
+    def __init__(self, stream: typing.BinaryIO):
+        self.stream = stream
+        self._remaining = 0
+        self._padding = 0
+        self._length = 0
+
+    def _write(self, data: bytes) -> None:
+        self.stream.write(data)
+        self._length += len(data)
+
+    def begin(self, name: str, size: typing.Optional[int]) -> None:
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._write(info.tobuf(tarfile.PAX_FORMAT))
+        self._remaining = size
+        self._padding = -size % tarfile.BLOCKSIZE
+
+    def write(self, data: bytes) -> None:
+        data = data[:self._remaining]
+        self._write(data)
+        self._remaining -= len(data)
+
+    def end(self, complete: bool) -> None:
+        '''Finish entry. Header of tar entry is written already, so the data
+        of incomplete one is padded with zeros to its size'''
+        self._write(bytes(self._remaining + self._padding))
+        self._remaining = self._padding = 0
+
+    def close(self) -> None:
+        import tarfile
+        self._write(bytes(2 * tarfile.BLOCKSIZE))
+        self._write(bytes(-self._length % tarfile.RECORDSIZE))
+        self.stream.flush()
+
+
+class ZipArchiveWriter:
+    '''Class to write zip archive to stream, which needs not be seekable,
+    entry by entry. Images are compressed already, so entries are stored'''
+    requires_size = False
+
+    def __init__(self, stream: typing.BinaryIO):
+        import zipfile
+        self.stream = stream
+        self._zip = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+        self._entry = None
+
+    def begin(self, name: str, size: typing.Optional[int]) -> None:
+        import zipfile
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        if size is not None:
+            info.file_size = size
+        self._entry = self._zip.open(
+            info, 'w', force_zip64=size is None or size >= 2 ** 31 - 1)
+
+    def write(self, data: bytes) -> None:
+        self._entry.write(data)
+
+    def end(self, complete: bool) -> None:
+        '''Finish entry, incomplete one keeps data written so far'''
+        self._entry.close()
+        self._entry = None
+
+    def close(self) -> None:
+        self._zip.close()
+        self.stream.flush()
+
+
+class ArchiveEntry:
+    '''Class to represent file being streamed into archive, with buffer of
+    chunks waiting for their turn to be written'''
+
+    def __init__(self, name: str, size: typing.Optional[int], buffer_chunks: int):
+        import asyncio
+        self.name = name
+        self.size = size
+        self.written = 0
+        self.chunks = asyncio.Queue(buffer_chunks)
+
+    async def write(self, data: bytes) -> None:
+        '''Queue data, wait while buffer of entry is full'''
+        await self.chunks.put(data)
+        self.written += len(data)
+
+    async def finish(self, complete: bool) -> None:
+        await self.chunks.put(complete)
+
+
+class ArchiveStream:
+    '''Class to stream concurrent downloads into one archive.
+
+    Entries are written one by one, in order they were added. Entry being
+    written is copied to archive as its chunks arrive, the others keep up
+    to buffer_size bytes each and then stop reading their responses, so
+    memory is bounded and nothing is written to temporary files. root is
+    directory which names of entries are relative to.
+    '''
+
+    def __init__(self, writer: typing.Union[TarArchiveWriter, ZipArchiveWriter],
+                 root: str, buffer_size: int = 4 * CHUNK_SIZE,
+                 executor: typing.Optional[concurrent.futures.Executor] = None):
+        self.writer = writer
+        self.root = root
+        self.buffer_size = buffer_size
+        self.executor = executor
+        self.count = 0
+        self.error = None
+        self._entries = None
+        self._task = None
+
+    def get_name(self, path: str) -> str:
+        '''Return name of entry for path of file in base directory'''
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def add(self, path: str, size: typing.Optional[int], chunk_size: int) -> ArchiveEntry:
+        '''Queue entry for file with given path and size, unknown size is
+        accepted by zip only'''
+        if size is None and self.writer.requires_size:
+            raise ValueError('Size of image is unknown, it can not be added to tar archive')
+        if self._task is None:
+            self._start()
+        entry = ArchiveEntry(self.get_name(path), size, max(1, self.buffer_size // chunk_size))
+        self._entries.put_nowait(entry)
+        return entry
+
+    def _start(self) -> None:
+        # Queue is bound to running loop, so writer is started lazily
+        import asyncio
+        self._entries = asyncio.Queue()
+        self._task = asyncio.create_task(self._write_entries())
+
+    async def _write_entries(self) -> None:
+        import asyncio
+        loop = asyncio.get_running_loop()
+
+        async def call(function, *args):
+            # Once archive failed, remaining data is drained, so that
+            # downloads waiting for their turn do not hang
+            if self.error is None:
+                try:
+                    await loop.run_in_executor(self.executor, function, *args)
+                except Exception as err:
+                    self.error = err
+
+        while True:
+            entry = await self._entries.get()
+            if entry is None:
+                break
+            await call(self.writer.begin, entry.name, entry.size)
+            while True:
+                chunk = await entry.chunks.get()
+                if isinstance(chunk, bool):
+                    await call(self.writer.end, chunk)
+                    break
+                await call(self.writer.write, chunk)
+            self.count += 1
+        await call(self.writer.close)
+
+    async def close(self) -> None:
+        '''Write queued entries and end of archive, raise error of writing'''
+        if self._task is None:
+            self._start()
+        self._entries.put_nowait(None)
+        await self._task
+        if self.error is not None:
+            raise self.error
+
+
+class PageResponse(typing.NamedTuple):
+    '''Details of response to page request'''
+    status: int
+    content: bytes
+    etag: typing.Optional[str] = None
+    last_modified: typing.Optional[str] = None
+
+
+class CachedPage(typing.NamedTuple):
+    '''Page kept in page cache with links found on it grouped by resolution'''
+    url: str
+    content: bytes
+    etag: typing.Optional[str]
+    last_modified: typing.Optional[str]
+    fetched_at: float
+    index: typing.Dict[str, typing.List[str]]
+
+
+class PageCache:
+    '''Class to represent on-disk cache of calendar pages.
+
+    Pages are kept in SQLite database together with validators and links
+    of every resolution found on them, so fresh page needs neither request
+    nor parsing. Least recently used pages are evicted when total size of
+    pages exceeds max_size bytes.
+    '''
+
+    def __init__(self, path: str, ttl: float = CACHE_TTL * 24 * 3600,
+                 max_size: int = CACHE_SIZE * 2 ** 20):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._connection = sqlite3.connect(path, timeout=30)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'url TEXT PRIMARY KEY, content BLOB NOT NULL, etag TEXT, '
+                'last_modified TEXT, fetched_at REAL NOT NULL, '
+                'accessed_at REAL NOT NULL, link_index TEXT NOT NULL)'
+            )
+
+    def get(self, url: str) -> typing.Optional[CachedPage]:
+        '''Return cached page, if there is one'''
+        import json
+        row = self._connection.execute(
+            'SELECT url, content, etag, last_modified, fetched_at, link_index '
+            'FROM pages WHERE url = ?', (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._connection:
+            self._connection.execute(
+                'UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        return CachedPage(*row[:5], json.loads(row[5]))
+
+    def is_fresh(self, page: CachedPage) -> bool:
+        '''Return whether page can be used without revalidation'''
+        return time.time() - page.fetched_at < self.ttl
+
+    def put(self, url: str, response: PageResponse,
+            index: typing.Mapping[str, typing.List[str]]) -> None:
+        '''Add or replace page and evict least recently used pages'''
+        import json
+        now = time.time()
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO pages (url, content, etag, last_modified, '
+                'fetched_at, accessed_at, link_index) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, response.content, response.etag, response.last_modified,
+                 now, now, json.dumps(index))
+            )
+            self.evict()
+
+    def revalidated(self, url: str) -> None:
+        '''Mark page as confirmed unchanged by server'''
+        with self._connection:
+            self._connection.execute(
+                'UPDATE pages SET fetched_at = ? WHERE url = ?', (time.time(), url))
+
+    def evict(self) -> None:
+        '''Remove least recently used pages until cache fits max_size'''
+        total = 0
+        for url, size in self._connection.execute(
+                'SELECT url, length(content) FROM pages ORDER BY accessed_at DESC').fetchall():
+            total += size
+            if total > self.max_size:
+                self._connection.execute('DELETE FROM pages WHERE url = ?', (url,))
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class WorkQueue:
+    '''Class to represent queue of (year, month) units shared by worker
+    processes, possibly on several machines with common filesystem.
+
+    Unit is claimed by one worker for lease seconds and the worker extends
+    the lease while it is alive, so units of crashed worker are claimed
+    again when their lease expires. Unit lost by max_attempts workers is
+    marked as failed.
+    '''
+
+    def __init__(self, path: str, lease: float = 300.0, max_attempts: int = 3):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # Transactions are begun explicitly, so that claim takes write lock
+        # before reading
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS units ('
+            'year INTEGER NOT NULL, month INTEGER NOT NULL, '
+            "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, expires REAL, "
+            'attempts INTEGER NOT NULL DEFAULT 0, found INTEGER, downloaded INTEGER, '
+            'error TEXT, PRIMARY KEY (year, month))'
+        )
+
+    @contextlib.contextmanager
+    def _transaction(self) -> typing.Iterator[None]:
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        else:
+            self._connection.execute('COMMIT')
+
+    def add(self, units: typing.Iterable[typing.Tuple[int, int]]) -> None:
+        '''Add (year, month) units, units which failed before are queued again'''
+        with self._transaction():
+            for year, month in units:
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO units (year, month) VALUES (?, ?)', (year, month))
+                self._connection.execute(
+                    "UPDATE units SET state = 'pending', attempts = 0, found = NULL, "
+                    'downloaded = NULL, error = NULL '
+                    "WHERE year = ? AND month = ? AND state = 'failed'", (year, month))
+
+    def claim(self, worker: str) -> typing.Optional[typing.Tuple[int, int]]:
+        '''Claim the earliest pending unit or unit with expired lease for
+        given worker, return None if there is no such unit'''
+        now = time.time()
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE units SET state = 'failed', worker = NULL, expires = NULL, "
+                "error = 'Worker was lost ' || attempts || ' times' "
+                "WHERE state = 'claimed' AND expires < ? AND attempts >= ?",
+                (now, self.max_attempts))
+            row = self._connection.execute(
+                "SELECT year, month FROM units WHERE state = 'pending' "
+                "OR (state = 'claimed' AND expires < ?) ORDER BY year, month LIMIT 1",
+                (now,)).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    "UPDATE units SET state = 'claimed', worker = ?, expires = ?, "
+                    'attempts = attempts + 1 WHERE year = ? AND month = ?',
+                    (worker, now + self.lease) + row)
+        return row
+
+    def release(self, worker: str) -> int:
+        '''Return units of given worker, known to be dead, to the queue
+        without waiting for their lease to expire, return number of units
+        queued again. Unit lost max_attempts times is marked as failed'''
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE units SET state = 'failed', worker = NULL, expires = NULL, "
+                "error = 'Worker was lost ' || attempts || ' times' "
+                "WHERE state = 'claimed' AND worker = ? AND attempts >= ?",
+                (worker, self.max_attempts))
+            cursor = self._connection.execute(
+                "UPDATE units SET state = 'pending', worker = NULL, expires = NULL "
+                "WHERE state = 'claimed' AND worker = ?", (worker,))
+        return cursor.rowcount
+
+    def heartbeat(self, worker: str) -> None:
+        '''Extend lease of every unit held by given worker'''
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE units SET expires = ? WHERE state = 'claimed' AND worker = ?",
+                (time.time() + self.lease, worker))
+
+    def complete(self, worker: str, report: MonthReport) -> bool:
+        '''Record outcome of unit, return False if the worker lost the unit
+        to another one meanwhile'''
+        with self._transaction():
+            cursor = self._connection.execute(
+                'UPDATE units SET state = ?, worker = NULL, expires = NULL, found = ?, '
+                "downloaded = ?, error = ? WHERE year = ? AND month = ? "
+                "AND state = 'claimed' AND worker = ?",
+                ('failed' if report.error else 'done', report.found, report.downloaded,
+                 report.error, report.year, report.month.number, worker))
+        return cursor.rowcount == 1
+
+    def get_counts(self) -> typing.Dict[str, typing.Tuple[int, int, int]]:
+        '''Return number of units, found and downloaded images by state'''
+        return {state: (units, found or 0, downloaded or 0) for state, units, found, downloaded
+                in self._connection.execute(
+                    'SELECT state, count(*), sum(found), sum(downloaded) '
+                    'FROM units GROUP BY state')}
+
+    def get_failures(self) -> typing.List[typing.Tuple[int, int, str]]:
+        '''Return (year, month, error) of failed units'''
+        return self._connection.execute(
+            "SELECT year, month, error FROM units WHERE state = 'failed' "
+            'ORDER BY year, month').fetchall()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class CatalogueEntry(typing.NamedTuple):
+    '''Wallpaper found on calendar page'''
+    year: int
+    month: int
+    design: str
+    variant: typing.Optional[str]
+    resolution: str
+    url: str
+    size: typing.Optional[int] = None
+
+
+def parse_wallpaper_link(link: str) -> typing.Tuple[str, typing.Optional[str]]:
+    '''Return design slug and variant (cal or nocal) of wallpaper link, like
+    .../wallpapers/may-19/slug/cal/may-19-slug-cal-1920x1080.png'''
+    path = urllib.parse.urlsplit(link).path
+    match = re.search(r'/wallpapers/[^/]+/([^/]+)/(cal|nocal)/[^/]+$', path)
+    if match:
+        return match.group(1), match.group(2)
+    # Unknown layout, name of file without resolution stands for design
+    name = os.path.splitext(path[path.rfind('/') + 1:])[0]
+    return re.sub(r'-?\d{3,4}x\d{3,4}$', '', name), None
+
+
+class Catalogue:
+    '''Class to represent on-disk index of wallpapers of all months.
+
+    Entries are kept in SQLite database indexed by resolution and by
+    month, so queries need neither requests nor parsing.
+    '''
+
+    def __init__(self, path: str):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS wallpapers ('
+                'url TEXT NOT NULL, year INTEGER NOT NULL, month INTEGER NOT NULL, '
+                'design TEXT NOT NULL, variant TEXT, resolution TEXT NOT NULL, '
+                'width INTEGER NOT NULL, height INTEGER NOT NULL, size INTEGER)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS wallpapers_resolution '
+                'ON wallpapers (resolution, variant, year, month)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS wallpapers_month '
+                'ON wallpapers (year, month)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS wallpapers_width '
+                'ON wallpapers (width, height)')
+
+    def replace_month(self, year: int, month: int,
+                      entries: typing.Iterable[CatalogueEntry]) -> None:
+        '''Replace entries of given month'''
+        # Entries are replaced by month only, so urls are not indexed and
+        # stored once
+        with self._connection:
+            self._connection.execute(
+                'DELETE FROM wallpapers WHERE year = ? AND month = ?', (year, month))
+            self._connection.executemany(
+                'INSERT INTO wallpapers (url, year, month, design, variant, '
+                'resolution, width, height, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(entry.url, entry.year, entry.month, entry.design, entry.variant,
+                  entry.resolution) + tuple(map(int, entry.resolution.split('x'))) +
+                 (entry.size,) for entry in entries])
+
+    def query(self, resolutions: typing.Sequence[str] = (),
+              years: typing.Sequence[int] = (), months: typing.Sequence[int] = (),
+              variant: typing.Optional[str] = None, design: typing.Optional[str] = None,
+              min_width: typing.Optional[int] = None,
+              min_height: typing.Optional[int] = None) -> typing.List[CatalogueEntry]:
+        '''Return entries matching every given condition, ordered by month.
+        Design is matched as substring of slug'''
+        conditions, values = [], []
+        for column, accepted in (('resolution', resolutions), ('year', years),
+                                 ('month', months)):
+            if accepted:
+                conditions.append('{0} IN ({1})'.format(column, ', '.join('?' * len(accepted))))
+                values.extend(accepted)
+        if variant is not None:
+            conditions.append('variant = ?')
+            values.append(variant)
+        if design is not None:
+            conditions.append("design LIKE ? ESCAPE '\\'")
+            values.append('%{}%'.format(re.sub(r'([%_\\])', r'\\\1', design)))
+        for column, minimum in (('width', min_width), ('height', min_height)):
+            if minimum is not None:
+                conditions.append('{} >= ?'.format(column))
+                values.append(minimum)
+        sql = 'SELECT year, month, design, variant, resolution, url, size FROM wallpapers'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY year, month, rowid'
+        return [CatalogueEntry(*row) for row in self._connection.execute(sql, values)]
+
+    def count(self) -> int:
+        return self._connection.execute('SELECT count(*) FROM wallpapers').fetchone()[0]
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class Metrics:
+    '''Class to collect timings, transferred bytes and errors of run stages.
+
+    Duration of every call of stage is summed and counted in histogram;
+    stages run concurrently, so their total durations may exceed duration
+    of the run.
+    '''
+
+    def __init__(self, buckets: typing.Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        # Number of calls of stage by upper bound of bucket, the last one
+        # is for calls slower than any bound
+        self.histograms = collections.defaultdict(
+            lambda: [0] * (len(self.buckets) + 1))
+        # Number of failed calls by stage and reason
+        self.errors = collections.Counter()
+        self.bytes = 0
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        '''Measure duration of code block as one call of stage, record
+        reason of exception raised in it'''
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as err:
+            self.errors[name, describe_error(err)] += 1
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def observe(self, name: str, seconds: float) -> None:
+        '''Record one call of stage with given duration'''
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+        histogram = self.histograms[name]
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        else:
+            histogram[-1] += 1
+
+    def get_quantile(self, name: str, quantile: float) -> typing.Optional[float]:
+        '''Return upper bound of bucket containing given quantile of stage
+        durations, None if it is in the last unbounded bucket'''
+        histogram = self.histograms[name]
+        rank, count = quantile * sum(histogram), 0
+        for bound, bucket in zip(self.buckets, histogram):
+            count += bucket
+            if count >= rank:
+                return bound
+        return None
+
+    def get_report(self, image_downloader: 'ImageDownloader') -> typing.Dict[str, typing.Any]:
+        '''Return structured report of run by given downloader'''
+        duration = time.perf_counter() - self._clock
+        stages = {}
+        for name in sorted(self.calls):
+            stages[name] = {
+                'calls': self.calls[name],
+                'seconds': round(self.seconds[name], 6),
+                'p50': self.get_quantile(name, 0.5),
+                'p95': self.get_quantile(name, 0.95),
+                'histogram': dict(zip(
+                    [str(bound) for bound in self.buckets] + ['+Inf'],
+                    self.histograms[name])),
+            }
+        return {
+            'started': self.started,
+            'duration': round(duration, 6),
+            'images': {outcome: image_downloader.stats[outcome]
+                       for outcome in ('downloaded', 'unchanged', 'failed')},
+            # Subset of downloaded images
+            'deduplicated': image_downloader.stats['deduplicated'],
+            'retries': image_downloader.stats['retries'],
+            'cached_pages': image_downloader.stats['cached_pages'],
+            'bytes': self.bytes,
+            'throughput_mb_s': round(self.bytes / 2 ** 20 / duration, 3) if duration else 0.0,
+            'concurrency': {
+                'limit': image_downloader.concurrency.limit,
+                'peak': image_downloader.concurrency.peak,
+            },
+            'stages': stages,
+            'errors': [{'stage': stage, 'reason': reason, 'count': count}
+                       for (stage, reason), count in sorted(self.errors.items())],
+        }
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(report: typing.Mapping[str, typing.Any],
+                      prefix: str = 'smashing') -> str:
+    '''Return report in Prometheus text exposition format'''
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help_text))
+        lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+        for suffix, labels, value in samples:
+            label_text = ','.join('{0}="{1}"'.format(key, _escape_label(str(label)))
+                                  for key, label in labels)
+            lines.append('{0}_{1}{2}{3} {4}'.format(
+                prefix, name, suffix, '{' + label_text + '}' if label_text else '', value))
+
+    metric('run_start_time_seconds', 'gauge', 'Start time of run.',
+           [('', (), report['started'])])
+    metric('run_duration_seconds', 'gauge', 'Duration of run.',
+           [('', (), report['duration'])])
+    metric('images', 'gauge', 'Number of images by outcome.',
+           [('', (('outcome', outcome),), count)
+            for outcome, count in sorted(report['images'].items())])
+    metric('deduplicated_images', 'gauge',
+           'Downloaded images which were in content store already.',
+           [('', (), report['deduplicated'])])
+    metric('retries', 'gauge', 'Number of retried requests.',
+           [('', (), report['retries'])])
+    metric('cached_pages', 'gauge', 'Number of calendar pages taken from cache.',
+           [('', (), report['cached_pages'])])
+    metric('received_bytes', 'gauge', 'Bytes of images received.',
+           [('', (), report['bytes'])])
+    metric('throughput_bytes_per_second', 'gauge', 'Average download throughput.',
+           [('', (), report['throughput_mb_s'] * 2 ** 20)])
+    metric('concurrency_limit', 'gauge', 'Final limit of requests in flight.',
+           [('', (), report['concurrency']['limit'])])
+    metric('concurrency_peak', 'gauge', 'Peak number of requests in flight.',
+           [('', (), report['concurrency']['peak'])])
+    samples = []
+    for stage, values in report['stages'].items():
+        count = 0
+        for bound, bucket in values['histogram'].items():
+            count += bucket
+            samples.append(('_bucket', (('stage', stage), ('le', bound)), count))
+        samples.append(('_sum', (('stage', stage),), values['seconds']))
+        samples.append(('_count', (('stage', stage),), values['calls']))
+    metric('stage_duration_seconds', 'histogram', 'Duration of run stages.', samples)
+    metric('errors', 'gauge', 'Number of failed calls by stage and reason.',
+           [('', (('stage', error['stage']), ('reason', error['reason'])), error['count'])
+            for error in report['errors']])
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(path: str, text: str) -> None:
+    '''Write report atomically, so that collectors never read partial file'''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+class LinkCollector:
+    '''Target for lxml parser, collects links with required text grouped
+    by that text.
+
+    Receives parser events instead of building a tree, so only text of
+    currently open <a> elements is kept in memory.
+    '''
+
+    def __init__(self, is_required: typing.Callable[[str], bool]):
+        self.is_required = is_required
+        self._open_links = []
+        self._found = []
+        self._count = 0
+
+    def start(self, tag: str, attrib: typing.Mapping[str, str]) -> None:
+        if tag == 'a':
+            self._open_links.append((self._count, attrib.get('href'), []))
+            self._count += 1
+
+    def end(self, tag: str) -> None:
+        if tag == 'a' and self._open_links:
+            order, href, parts = self._open_links.pop()
+            text = ''.join(parts)
+            if self.is_required(text):
+                self._found.append((order, text, href))
+
+    def data(self, data: str) -> None:
+        # Text of nested element belongs to every enclosing link
+        for _, _, parts in self._open_links:
+            parts.append(data)
+
+    def close(self) -> typing.Dict[str, typing.List[str]]:
+        # Nested links are finished before enclosing ones, restore
+        # document order of opening tags
+        index = {}
+        for _, text, href in sorted(self._found, key=lambda found: found[0]):
+            index.setdefault(text, []).append(href)
+        return index
+
+
 class ImageDownloader:
     '''Class to represent downloader for images.'''
 
-    def __init__(self, resolution):
-        self.resolution = self.validate_input(resolution)
+    def __init__(self, resolution: typing.Union[str, typing.Sequence[str], None],
+                 parser=PARSERS[0],
+                 manifest: typing.Optional[Manifest] = None, sync=False,
+                 concurrency: typing.Optional[FixedConcurrency] = None,
+                 retry: typing.Optional[RetryPolicy] = None,
+                 order=ORDERS[0], queue_size: int = 256,
+                 chunk_size: int = CHUNK_SIZE,
+                 store: typing.Optional[ContentStore] = None,
+                 page_cache: typing.Optional[PageCache] = None,
+                 archive: typing.Optional[ArchiveStream] = None,
+                 limiter: typing.Optional[RateLimiter] = None):
+        # Resolution is either one resolution, sequence of them, or None
+        # for all resolutions found on page
+        if resolution is None:
+            self.resolutions = None
+        elif isinstance(resolution, str):
+            self.resolutions = (self.validate_input(resolution),)
+        else:
+            self.resolutions = tuple(dict.fromkeys(
+                self.validate_input(value) for value in resolution))
+            if not self.resolutions:
+                raise ValueError('Resolution value is not valid', resolution)
+        # Images are stored in subdirectory per resolution, unless there
+        # is only one
+        self.resolution = self.resolutions[0] \
+            if self.resolutions and len(self.resolutions) == 1 else None
+        if parser not in PARSERS:
+            raise ValueError('Parser is not valid', parser)
+        self.parser = parser
+        self.manifest = manifest
+        self.sync = sync
+        self.concurrency = concurrency or FixedConcurrency()
+        self.retry = retry or RetryPolicy()
+        if order not in ORDERS:
+            raise ValueError('Order is not valid', order)
+        self.order = order
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.store = store
+        self.page_cache = page_cache
+        # Images are streamed into archive instead of month directories
+        self.archive = archive
+        self.limiter = limiter or RateLimiter()
+        self.metrics = Metrics()
+        self._io_executor = None
+        self.breakers = collections.defaultdict(CircuitBreaker)
+        # Number of images by outcome: downloaded, unchanged, failed,
+        # number of downloaded images which were in content store already,
+        # number of retried requests and pages taken from cache
+        self.stats = collections.Counter()
+        # Links of images which were not downloaded, with reasons
+        self.failures = []
+
+    @property
+    def io_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        '''Return executor dedicated to disk I/O of image files'''
+        import concurrent.futures
+        if self._io_executor is None:
+            self._io_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix='smashing-io')
+        return self._io_executor
+
+    def close(self) -> None:
+        '''Shut down disk I/O executor'''
+        if self._io_executor is not None:
+            self._io_executor.shutdown()
+            self._io_executor = None
 
     @staticmethod
     def validate_input(value: str) -> str:
         '''Make sure user input resolution is valid'''
-        match = re.search('^\d{3,4}x\d{3,4}$', value)
+        match = re.search(RESOLUTION_PATTERN, value)
         if match:
             return value
         raise ValueError('Resolution value is not valid', value)
@@ -77,12 +1560,18 @@ class ImageDownloader:
         )
         return url
 
-    def create_directory(self, basic_directory: str, month_name: str, year: int) -> str:
-        '''Create directory to store downloaded files'''
+    def create_directory(self, basic_directory: str, month_name: str,
+                         year: typing.Optional[int] = None) -> str:
+        '''Create directory to store downloaded files. Without year, create
+        subdirectory with given name'''
         storage_path = os.path.join(
             basic_directory,
             'Smashing_wallpaper_{0}_{1}'.format(month_name, str(year))
+            if year is not None else month_name
         )
+        if self.archive is not None:
+            # Path only names entries of archive
+            return storage_path
         try:
             os.makedirs(storage_path, exist_ok=True)
         except OSError as err:
@@ -91,119 +1580,1259 @@ class ImageDownloader:
         else:
             return storage_path
 
-    def fetch_content(self, url: str, **kwargs) -> bytes:
-        '''Make HTTP GET request to given url and return response content'''
+    async def with_retry(self, url: str,
+                         request: typing.Callable[[], typing.Awaitable]) -> typing.Any:
+        '''Make request to given url, repeat it on transient errors unless
+        circuit breaker of the host is open'''
+        import asyncio
+        breaker = self.breakers[urllib.parse.urlsplit(url).netloc]
+        attempt = 1
+        while True:
+            trial = breaker.check()
+            try:
+                result = await request()
+            except Exception as err:
+                if self.retry.is_retryable(err):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                delay = self.retry.get_delay(attempt, err)
+                if delay is None:
+                    raise
+            except BaseException:
+                # Cancelled trial would keep the circuit half-open for good
+                if trial:
+                    breaker.abort_trial()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            self.stats['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def fetch_page(self, session: aiohttp.ClientSession,
+                         url: str, **kwargs) -> PageResponse:
+        '''Make HTTP GET request to given url and return response status,
+        content and validators'''
+        import asyncio
+        import aiohttp
+        async def request():
+            await self.limiter.request(url)
+            async with session.get(url, **kwargs) as response:
+                response.raise_for_status()
+                return PageResponse(
+                    response.status,
+                    await response.read(),
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified')
+                )
+
         try:
-            response = requests.get(url, **kwargs)
-            response.raise_for_status()
-        except requests.Timeout:
+            with self.metrics.stage('fetch_page'):
+                return await self.with_retry(url, request)
+        except CircuitOpenError as err:
+            raise Exception(str(err))
+        except asyncio.TimeoutError:
             raise Exception('Connection timed out')
-        except requests.HTTPError:
-            raise Exception('Error {}'.format(response.status_code))
-        except requests.RequestException:
+        except aiohttp.ClientResponseError as err:
+            raise Exception('Error {}'.format(err.status))
+        except aiohttp.ClientError:
             raise Exception('Unable to establish connection')
-        else:
-            return response.content
 
-    def get_image_links(self, content: bytes) -> typing.List[str]:
-        '''Parse page for links with required resolution and returns list of links'''
+    async def fetch_content(self, session: aiohttp.ClientSession,
+                            url: str, **kwargs) -> bytes:
+        '''Make HTTP GET request to given url and return response content'''
+        return (await self.fetch_page(session, url, **kwargs)).content
+
+    async def get_page_index(self, session: aiohttp.ClientSession,
+                             url: str) -> typing.Dict[str, typing.List[str]]:
+        '''Return links with required resolutions found on page, grouped by
+        resolution. Page cache is used, if there is one: fresh page needs
+        neither request nor parsing, stale one is revalidated with
+        conditional request'''
+        import asyncio
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        if self.page_cache is None:
+            content = await self.fetch_content(session, url, timeout=timeout)
+            # Parsing is CPU bound, keep it away from the loop serving downloads
+            with self.metrics.stage('parse'):
+                return await loop.run_in_executor(None, self.get_link_index, content)
+
+        page = self.page_cache.get(url)
+        if page is not None and self.page_cache.is_fresh(page):
+            self.stats['cached_pages'] += 1
+            return self.select_links(page.index)
+        headers = {}
+        if page is not None and page.etag:
+            headers['If-None-Match'] = page.etag
+        if page is not None and page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+        response = await self.fetch_page(session, url, headers=headers, timeout=timeout)
+        if response.status == 304 and page is not None:
+            self.page_cache.revalidated(url)
+            self.stats['cached_pages'] += 1
+            return self.select_links(page.index)
+        # Links of every resolution are cached, so that other resolutions
+        # can be taken from cache later
+        with self.metrics.stage('parse'):
+            index = await loop.run_in_executor(
+                None, self.get_link_index, response.content, is_resolution)
+        self.page_cache.put(url, response, index)
+        return self.select_links(index)
+
+    def select_links(self, index: typing.Mapping[str, typing.List[str]]
+                     ) -> typing.Dict[str, typing.List[str]]:
+        '''Return links of required resolutions from links of all resolutions'''
+        return {resolution: links for resolution, links in index.items()
+                if self.is_required(resolution)}
+
+    def is_required(self, text: str) -> bool:
+        '''Return whether link with given text has required resolution'''
+        if self.resolutions is None:
+            return is_resolution(text)
+        return text in self.resolutions
+
+    def get_link_index(self, content: bytes,
+                       is_required: typing.Callable[[str], bool] = None
+                       ) -> typing.Dict[str, typing.List[str]]:
+        '''Parse page for links with required resolutions in one pass, return
+        lists of links grouped by resolution'''
+        is_required = is_required or self.is_required
+        if self.parser == 'soup':
+            return self.get_link_index_soup(content, is_required)
+        return self.get_link_index_stream(content, is_required)
+
+    def get_link_index_stream(self, content: bytes,
+                              is_required: typing.Callable[[str], bool]
+                              ) -> typing.Dict[str, typing.List[str]]:
+        '''Parse page for links with required resolutions without building tree'''
+        from lxml import etree
+        parser = etree.HTMLParser(target=LinkCollector(is_required))
+        parser.feed(content)
+        return parser.close()
+
+    def get_link_index_soup(self, content: bytes,
+                            is_required: typing.Callable[[str], bool]
+                            ) -> typing.Dict[str, typing.List[str]]:
+        '''Parse page for links with required resolutions using BeautifulSoup'''
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(content, 'lxml')
-        image_links = []
+        index = {}
 
         for link in soup.find_all('a'):
-            if link.text == self.resolution:
-                image_links.append(link.get('href'))
-        return image_links
+            if is_required(link.text):
+                index.setdefault(link.text, []).append(link.get('href'))
+        return index
+
+    def get_image_links(self, content: bytes) -> typing.List[str]:
+        '''Parse page for links with required resolution and returns list of links'''
+        return [link for links in self.get_link_index(content).values()
+                for link in links]
+
+    def get_targets(self, storage_path: str,
+                    index: typing.Mapping[str, typing.List[str]]
+                    ) -> typing.List[typing.Tuple[str, str]]:
+        '''Return (directory, link) pairs for links grouped by resolution,
+        creating subdirectory for every resolution if there are several'''
+        if self.resolution is not None:
+            return [(storage_path, link) for link in index.get(self.resolution, [])]
+        targets = []
+        for resolution, links in index.items():
+            directory = self.create_directory(storage_path, resolution)
+            targets.extend((directory, link) for link in links)
+        return targets
+
+    async def fetch_image(self, session: aiohttp.ClientSession, link: str,
+                          part_path: str, headers: typing.Mapping[str, str] = None
+                          ) -> ImageResponse:
+        '''Stream image from given link into part file, resuming it if it
+        exists. Return response details with expected size of complete file,
+        if server reports it, and SHA-256 digest computed on the stream'''
+        import asyncio
+        import hashlib
+        headers = dict(headers or {})
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        await self.limiter.request(link)
+        async with session.get(link, headers=headers) as response:
+            if offset and response.status == 416:
+                # Part file is stale or already longer than image, start over
+                os.remove(part_path)
+                return await self.fetch_image(session, link, part_path, headers={
+                    key: value for key, value in headers.items() if key != 'Range'})
+            response.raise_for_status()
+            if response.status == 304:
+                return ImageResponse(response.status)
+            content_range = parse_content_range(
+                response.headers.get('Content-Range', ''))
+            if response.status != 206 or not content_range \
+                    or content_range[0] != offset:
+                # Server ignored range request, download whole image
+                offset = 0
+            size = None if response.content_length is None \
+                else offset + response.content_length
+            digest = hashlib.sha256()
+            head = b''
+            if offset:
+                # Resumed part is hashed once, the rest is hashed on the stream
+                head = await asyncio.get_running_loop().run_in_executor(
+                    self.io_executor, hash_part_file, part_path, offset, digest)
+            received, body_head = await self.write_part_file(
+                response.content, part_path, offset, digest, link)
+            if sniff_image_type((head + body_head)[:SIGNATURE_SIZE]) is None:
+                os.remove(part_path)
+                raise InvalidImageError('Downloaded content is not an image')
+            if size is not None and offset + received != size:
+                raise IncompleteDownloadError('Incomplete download: {0} of {1} bytes'.format(
+                    offset + received, size))
+            return ImageResponse(
+                response.status,
+                size,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified'),
+                received,
+                digest.hexdigest()
+            )
+
+    async def write_part_file(self, content: aiohttp.StreamReader, part_path: str,
+                              offset: int, digest: 'hashlib._Hash',
+                              link: str = '') -> typing.Tuple[int, bytes]:
+        '''Write response body into part file from offset, feeding it to
+        digest. Received bytes count against rate limits of host of link.
+        Return number of written bytes and first bytes of body.
+
+        Body is read in blocks of chunk_size, each block is hashed and
+        written on I/O executor while the next one is received. Part file
+        is never longer than bytes written, so that after a crash the next
+        range request resumes right after them.
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(
+            self.io_executor, open_part_file, part_path, offset)
+        written, pending, block, head = 0, None, bytearray(), b''
+        try:
+            try:
+                async for chunk in content.iter_chunked(self.chunk_size):
+                    await self.limiter.receive(link, len(chunk))
+                    if len(head) < SIGNATURE_SIZE:
+                        head += chunk[:SIGNATURE_SIZE - len(head)]
+                    block += chunk
+                    if len(block) >= self.chunk_size:
+                        if pending is not None:
+                            previous, pending = pending, None
+                            written += await previous
+                        pending = loop.run_in_executor(
+                            self.io_executor, write_block, f, digest, block)
+                        block = bytearray()
+            finally:
+                # Received bytes are kept even if download failed, so that
+                # they need not be requested again
+                if pending is not None:
+                    written += await asyncio.shield(pending)
+                if block:
+                    written += await loop.run_in_executor(
+                        self.io_executor, write_block, f, digest, block)
+        finally:
+            await loop.run_in_executor(self.io_executor, f.close)
+        return written, head
+
+    def get_conditional_headers(self, link: str,
+                                image_path: str) -> typing.Optional[typing.Dict[str, str]]:
+        '''Return headers for conditional request of image recorded in
+        manifest, or None if image on disk is not the recorded one'''
+        entry = self.manifest.get(link) if self.manifest else None
+        if entry is None or entry.path != os.path.abspath(image_path) or \
+                not os.path.isfile(image_path) or \
+                os.path.getsize(image_path) != entry.size:
+            return None
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    async def request_image(self, session: aiohttp.ClientSession, link: str,
+                            part_path: str, headers: typing.Mapping[str, str] = None
+                            ) -> ImageResponse:
+        '''Fetch image within limit of concurrency policy, report the
+        outcome of request back to the policy'''
+        import asyncio
+        import aiohttp
+        received, congested = 0, False
+        started = await self.concurrency.acquire()
+        try:
+            response = await self.fetch_image(session, link, part_path, headers)
+            received = response.received
+            return response
+        except asyncio.TimeoutError:
+            congested = True
+            raise
+        except aiohttp.ClientResponseError as err:
+            congested = err.status == 429 or err.status >= 500
+            raise
+        finally:
+            await self.concurrency.release(started, received, congested)
 
     async def download_image(self, session: aiohttp.ClientSession,
-                             semaphore: asyncio.Semaphore,
-                             storage_path: str, link: str) -> bool:
-        '''Download image from given link'''
-        try:
-            async with semaphore:
-                async with session.get(link) as response:
-                    response.raise_for_status()
-                    image_name = link[link.rfind('/') + 1:]
-                    async with aiofiles.open(
-                        os.path.join(storage_path, image_name),
-                        mode='wb'
-                    ) as f:
-                        while True:
-                            chunk = await response.content.read(1024)
-                            if not chunk:
-                                break
-                            await f.write(chunk)
-        except Exception:
-            return False
-        else:
-            return True
+                             storage_path: str, link: str) -> DownloadResult:
+        '''Download image from given link, return result of download.
 
-    async def download_all(self, storage_path: str, links: typing.List[str]) -> int:
-        '''Download images from given list of links, return number of downloaded images'''
+        Image is written to <name>.part file, which is renamed when it is
+        complete. Interrupted download leaves part file in place, so the
+        next attempt requests only missing bytes. In sync mode image recorded
+        in manifest is requested conditionally and kept if unchanged; image
+        missing on disk is restored from content store first, if it is there.
+        '''
+        import asyncio
+        started = time.monotonic()
+        image_name = link[link.rfind('/') + 1:]
+        image_path = os.path.join(storage_path, image_name)
+        if self.archive is not None:
+            return await self.archive_image(session, link, image_path)
+        part_path = image_path + PART_SUFFIX
+        loop = asyncio.get_running_loop()
+
+        def result(status, received=0, error=None):
+            self.stats[status] += 1
+            return DownloadResult(link, image_path, status, received,
+                                  time.monotonic() - started, error)
+
+        if self.sync and self.store is not None and not os.path.exists(image_path):
+            entry = self.manifest.get(link) if self.manifest else None
+            if entry is not None and self.store.contains(entry.sha256):
+                await loop.run_in_executor(
+                    self.io_executor, self.store.restore, entry.sha256, image_path)
+                self.manifest.record(entry._replace(path=os.path.abspath(image_path)))
+        headers = self.get_conditional_headers(link, image_path) if self.sync else None
+        if headers == {}:
+            # Image was recorded without validators, matching size is the
+            # only evidence we have
+            return result('unchanged')
+        try:
+            if headers and os.path.exists(part_path):
+                # Never resume stale part of possibly changed image
+                os.remove(part_path)
+            with self.metrics.stage('download'):
+                response = await self.with_retry(link, lambda: self.request_image(
+                    session, link, part_path, headers))
+            self.metrics.bytes += response.received
+            if response.status == 304:
+                return result('unchanged')
+            size = os.path.getsize(part_path)
+            deduplicated = False
+            if self.store is None:
+                os.replace(part_path, image_path)
+            else:
+                deduplicated = await loop.run_in_executor(
+                    self.io_executor, self.store.commit, part_path, response.sha256,
+                    image_path)
+            if self.manifest is not None:
+                self.manifest.record(ManifestEntry(
+                    link, os.path.abspath(image_path), size,
+                    response.etag, response.last_modified, response.sha256))
+        except Exception as err:
+            self.failures.append((link, describe_error(err)))
+            return result('failed', error=describe_error(err))
+        if deduplicated:
+            # Deduplicated images are counted as downloaded as well
+            self.stats['downloaded'] += 1
+            return result('deduplicated', response.received)
+        return result('downloaded', response.received)
+
+    async def stream_image(self, session: aiohttp.ClientSession, link: str,
+                           image_path: str, entries: typing.List[ArchiveEntry]) -> None:
+        '''Stream image from given link into archive entry, which is added
+        on the first attempt and continued with range request on the next
+        ones'''
+        entry = entries[0] if entries else None
+        headers = {'Range': 'bytes={}-'.format(entry.written)} if entry and entry.written else {}
+        await self.limiter.request(link)
+        async with session.get(link, headers=headers) as response:
+            response.raise_for_status()
+            content_range = parse_content_range(response.headers.get('Content-Range', ''))
+            if headers and (response.status != 206 or not content_range
+                            or content_range[0] != entry.written):
+                raise IncompleteDownloadError(
+                    'Server ignored range request, archive entry can not be completed')
+
+            def add_entry(head):
+                # Entry is added once the content is known to be an image
+                if sniff_image_type(head[:SIGNATURE_SIZE]) is None:
+                    raise InvalidImageError('Downloaded content is not an image')
+                entries.append(self.archive.add(image_path, response.content_length,
+                                                self.chunk_size))
+                return entries[-1]
+
+            # Chunks may be shorter than signature, they are collected until
+            # it is complete
+            head = b''
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                await self.limiter.receive(link, len(chunk))
+                if entry is None:
+                    head += chunk
+                    if len(head) < SIGNATURE_SIZE:
+                        continue
+                    entry = add_entry(head)
+                    chunk, head = head, b''
+                await entry.write(chunk)
+            if entry is None:
+                # Body is shorter than signature
+                entry = add_entry(head)
+                await entry.write(head)
+            if entry.size is not None and entry.written != entry.size:
+                raise IncompleteDownloadError('Incomplete download: {0} of {1} bytes'.format(
+                    entry.written, entry.size))
+
+    async def archive_image(self, session: aiohttp.ClientSession, link: str,
+                            image_path: str) -> DownloadResult:
+        '''Download image from given link into archive.
+
+        Slot of concurrency policy is held for all attempts, so that retry
+        never waits for slots of downloads waiting for their turn in archive.
+        '''
+        entries = []
+        complete, error = False, None
+        started = await self.concurrency.acquire()
+        try:
+            with self.metrics.stage('download'):
+                await self.with_retry(link, lambda: self.stream_image(
+                    session, link, image_path, entries))
+            complete = True
+        except Exception as err:
+            error = describe_error(err)
+            if entries:
+                error += ', archive entry is incomplete'
+            self.failures.append((link, error))
+        finally:
+            received = entries[0].written if entries else 0
+            if entries:
+                await entries[0].finish(complete)
+            self.metrics.bytes += received
+            await self.concurrency.release(started, received)
+        status = 'downloaded' if complete else 'failed'
+        self.stats[status] += 1
+        return DownloadResult(link, self.archive.get_name(image_path), status, received,
+                              time.monotonic() - started, error)
+
+    def create_session(self, connector: typing.Optional[aiohttp.BaseConnector] = None
+                       ) -> aiohttp.ClientSession:
+        '''Create session with connection pool large enough for concurrency
+        policy. Given connector is used instead and left open, so that its
+        connections are reused by other sessions'''
+        import aiohttp
+        if connector is not None:
+            return aiohttp.ClientSession(connector=connector, connector_owner=False)
+        limit = getattr(self.concurrency, 'maximum', self.concurrency.limit)
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max(limit, 100)))
+
+    def get_size_hint(self, link: str) -> int:
+        '''Return expected size of image: recorded one, if image is in
+        manifest, otherwise its number of pixels'''
+        entry = self.manifest.get(link) if self.manifest else None
+        if entry is not None:
+            return entry.size
+        match = re.search(r'(\d{3,4})x(\d{3,4})', link[link.rfind('/') + 1:])
+        return int(match.group(1)) * int(match.group(2)) if match else 0
+
+    def get_priority(self, link: str, position: int) -> float:
+        '''Return priority of link in scheduler queue, lower goes first'''
+        if self.order == 'smallest':
+            return self.get_size_hint(link)
+        if self.order == 'largest':
+            return -self.get_size_hint(link)
+        return position
+
+    async def iter_downloads(
+            self, targets: typing.Union[typing.Iterable[typing.Tuple[str, str]],
+                                        typing.AsyncIterable[typing.Tuple[str, str]]],
+            session: typing.Optional[aiohttp.ClientSession] = None
+    ) -> typing.AsyncIterator[DownloadResult]:
+        '''Download images for (directory, link) pairs, yield result of
+        every image as soon as it completes.
+
+        Fixed pool of workers takes images from bounded queue, which is fed
+        lazily from targets, so memory does not grow with number of links.
+        Results wait for consumer in queue of the same size; when it is full,
+        workers stop taking images. Closing the generator or cancelling the
+        task iterating it cancels downloads in progress. Given session is
+        used and left open, otherwise the call creates its own.
+        '''
+        import asyncio
+        queue = asyncio.PriorityQueue(self.queue_size)
+        results = asyncio.Queue(self.queue_size)
+        workers_number = getattr(self.concurrency, 'maximum', self.concurrency.limit)
+        # Sentinel stopping worker, sorted after every image
+        finished = (float('inf'), float('inf'), '', None)
+
+        async def produce():
+            position = 0
+            if hasattr(targets, '__aiter__'):
+                async for storage_path, link in targets:
+                    await queue.put((self.get_priority(link, position), position,
+                                     storage_path, link))
+                    position += 1
+            else:
+                for storage_path, link in targets:
+                    await queue.put((self.get_priority(link, position), position,
+                                     storage_path, link))
+                    position += 1
+            for _ in range(workers_number):
+                await queue.put(finished)
+
+        async def work():
+            while True:
+                _, _, storage_path, link = await queue.get()
+                if link is None:
+                    return
+                await results.put(await self.download_image(session, storage_path, link))
+
+        async def finish():
+            error = None
+            try:
+                await asyncio.gather(*tasks)
+            except Exception as err:
+                error = err
+            # Not reached on cancellation, when nobody waits for the sentinel
+            await results.put(None)
+            if error is not None:
+                raise error
+
+        async with contextlib.AsyncExitStack() as stack:
+            if session is None:
+                session = await stack.enter_async_context(self.create_session())
+            tasks = [asyncio.create_task(produce())] + \
+                [asyncio.create_task(work()) for _ in range(workers_number)]
+            finisher = asyncio.create_task(finish())
+            try:
+                while True:
+                    result = await results.get()
+                    if result is None:
+                        break
+                    yield result
+                # Error of targets, if there was one
+                await finisher
+            finally:
+                for task in tasks + [finisher]:
+                    task.cancel()
+                await asyncio.gather(*tasks, finisher, return_exceptions=True)
+
+    async def download_targets(self, session: aiohttp.ClientSession,
+                               targets: typing.Iterable[typing.Tuple[str, str]]) -> int:
+        '''Download images for (directory, link) pairs using given session,
+        return number of downloaded images'''
         downloaded_image_count = 0
-        semaphore = asyncio.Semaphore(5)
-        async with aiohttp.ClientSession() as session:
-            tasks = [asyncio.create_task(self.download_image(
-                session, semaphore, storage_path, link)) for link in links]
-            for res in asyncio.as_completed(tasks):
-                result = await res
-                if result:
-                    downloaded_image_count += 1
+        async for result in self.iter_downloads(targets, session):
+            if result:
+                downloaded_image_count += 1
         return downloaded_image_count
 
+    async def download_links(self, session: aiohttp.ClientSession,
+                             storage_path: str, links: typing.List[str]) -> int:
+        '''Download images using given session, return number of downloaded images'''
+        return await self.download_targets(
+            session, ((storage_path, link) for link in links))
+
+    async def download_all(self, storage_path: str, links: typing.List[str],
+                           session: typing.Optional[aiohttp.ClientSession] = None) -> int:
+        '''Download images from given list of links, return number of downloaded images'''
+        if session is not None:
+            return await self.download_links(session, storage_path, links)
+        async with self.create_session() as session:
+            return await self.download_links(session, storage_path, links)
+
+    async def prepare_month(self, session: aiohttp.ClientSession, url: str,
+                            basic_directory: str, month: Month,
+                            year: int) -> typing.List[typing.Tuple[str, str]]:
+        '''Fetch and parse page of given month, create storage directory and
+        return (directory, link) pairs of images to download'''
+        index = await self.get_page_index(
+            session, self.get_url(url, month.number, month.name, year))
+        if not any(index.values()):
+            return []
+        storage_path = self.create_directory(basic_directory, month.name, year)
+        return self.get_targets(storage_path, index)
 
-@click.command()
-@click.option('-r', '--resolution',
-              help='Resolution, example: 1920x1080', required=True)
+    async def download_months(
+            self, url: str, basic_directory: str,
+            months: typing.Iterable[typing.Tuple[Month, int]],
+            session: typing.Optional[aiohttp.ClientSession] = None
+    ) -> typing.AsyncIterator[MonthReport]:
+        '''Download images for sequence of months in one event loop and
+        connection pool, yield report for each month in given order.
+
+        While images of month N are downloading, page of month N + 1 is
+        fetched and parsed, and its downloads are queued on the same
+        concurrency limit, so the network stays busy between months.
+        Given session is used and left open.
+        '''
+        import asyncio
+        async def process(month, year):
+            targets = await self.prepare_month(session, url, basic_directory, month, year)
+            downloaded_image_count = await self.download_targets(session, targets)
+            return MonthReport(month, year, len(targets), downloaded_image_count)
+
+        async def report(month, year, task):
+            try:
+                return await task
+            except Exception as err:
+                return MonthReport(month, year, 0, 0, str(err))
+
+        async with contextlib.AsyncExitStack() as stack:
+            if session is None:
+                session = await stack.enter_async_context(self.create_session())
+            previous = None
+            try:
+                for month, year in months:
+                    current = (month, year, asyncio.create_task(process(month, year)))
+                    if previous is not None:
+                        yield await report(*previous)
+                    previous = current
+                if previous is not None:
+                    yield await report(*previous)
+                    previous = None
+            finally:
+                if previous is not None:
+                    previous[2].cancel()
+
+    async def fetch_size(self, session: aiohttp.ClientSession,
+                         link: str) -> typing.Optional[int]:
+        '''Return size of image told by server in response to HEAD request'''
+        import aiohttp
+
+        async def request():
+            await self.limiter.request(link)
+            async with session.head(link, allow_redirects=True, timeout=aiohttp.ClientTimeout(
+                    total=FETCH_TIMEOUT)) as response:
+                response.raise_for_status()
+                return response.content_length
+
+        started = await self.concurrency.acquire()
+        try:
+            return await self.with_retry(link, request)
+        finally:
+            await self.concurrency.release(started)
+
+    async def index_month(self, session: aiohttp.ClientSession, url: str, month: Month,
+                          year: int, sizes: bool = False) -> typing.List[CatalogueEntry]:
+        '''Return entries of wallpapers of required resolutions found on page
+        of given month. Size is taken from manifest, or requested from
+        server if sizes is set'''
+        import asyncio
+        index = await self.get_page_index(
+            session, self.get_url(url, month.number, month.name, year))
+        entries = []
+        for resolution, links in index.items():
+            for link in links:
+                entry = self.manifest.get(link) if self.manifest else None
+                entries.append(CatalogueEntry(
+                    year, month.number, *parse_wallpaper_link(link), resolution, link,
+                    entry.size if entry is not None else None))
+        if sizes:
+            async def with_size(entry):
+                if entry.size is not None:
+                    return entry
+                try:
+                    return entry._replace(size=await self.fetch_size(session, entry.url))
+                except Exception:
+                    return entry
+
+            entries = await asyncio.gather(*[with_size(entry) for entry in entries])
+        return entries
+
+
+def _get_param(ctx: click.Context, name: str) -> click.Parameter:
+    '''Return parameter of current command by its name'''
+    return next(param for param in ctx.command.params if param.name == name)
+
+
+def print_summary(image_downloader: ImageDownloader) -> None:
+    '''Print number of images by outcome'''
+    stats = image_downloader.stats
+    if stats['downloaded'] or stats['unchanged']:
+        print('\nDownload complete. Downloaded {} images.'.format(stats['downloaded']))
+        if stats['unchanged']:
+            print('{} images are unchanged since last download.'.format(
+                stats['unchanged']))
+        if stats['deduplicated']:
+            print('{} downloaded images were in content store already.'.format(
+                stats['deduplicated']))
+    else:
+        print('Undefined issues occurred while attempting to download images.')
+    if image_downloader.failures:
+        print('Failed to download {} images:'.format(len(image_downloader.failures)))
+        for link, reason in image_downloader.failures:
+            print('  {0}: {1}'.format(link, reason))
+    if stats['retries']:
+        print('Retried {} requests.'.format(stats['retries']))
+    if stats['cached_pages']:
+        print('Used {} calendar pages from cache.'.format(stats['cached_pages']))
+    print('Concurrency limit: {0}, peak requests in flight: {1}.'.format(
+        image_downloader.concurrency.limit, image_downloader.concurrency.peak))
+
+
+async def aioenumerate(iterable: typing.AsyncIterable[typing.Any],
+                       start: int = 0) -> typing.AsyncIterator[typing.Tuple[int, typing.Any]]:
+    '''Asynchronous counterpart of enumerate'''
+    number = start
+    async for item in iterable:
+        yield number, item
+        number += 1
+
+
+def print_result(result: DownloadResult, number: int, total: int) -> None:
+    '''Print outcome of downloading one image'''
+    line = '[{0}/{1}] {2} {3}'.format(number, total, result.status,
+                                      os.path.basename(result.path))
+    if result.error:
+        line += ': ' + result.error
+    elif result.bytes:
+        line += ' ({0:.1f} KB in {1:.2f} s)'.format(result.bytes / 1024, result.duration)
+    print(line)
+
+
+async def download_month(image_downloader: ImageDownloader,
+                         month_obj: Month, year: int) -> None:
+    '''Download images for one month, whole run shares one connection pool'''
+    async with image_downloader.create_session() as session:
+        # Making GET request, parsing html page for image links with given
+        # parameters, creating storage directory for images
+        try:
+            targets = await image_downloader.prepare_month(
+                session, URL, BASE_DIR, month_obj, year)
+        except Exception as err:
+            print(err)
+            return
+        if not targets:
+            print('Unable to download images with given parameters.')
+            return
+
+        print('Connection established, start downloading...')
+
+        # Asynchronously downloading images, reporting each one as it completes
+        async for number, result in aioenumerate(
+                image_downloader.iter_downloads(targets, session), 1):
+            print_result(result, number, len(targets))
+
+    print_summary(image_downloader)
+
+
+def print_month_report(report: MonthReport) -> None:
+    '''Print outcome of downloading images for one month'''
+    if report.error:
+        print('{0} {1}: {2}'.format(report.month.name, report.year, report.error))
+    elif not report.found:
+        print('{0} {1}: no images with given parameters.'.format(
+            report.month.name, report.year))
+    else:
+        print('{0} {1}: downloaded {2} of {3} images.'.format(
+            report.month.name, report.year, report.downloaded, report.found))
+
+
+async def download_range(image_downloader: ImageDownloader,
+                         months: typing.Iterable[typing.Tuple[Month, int]]) -> None:
+    '''Download images for range of months and print report for each month'''
+    async for report in image_downloader.download_months(URL, BASE_DIR, months):
+        print_month_report(report)
+
+    print_summary(image_downloader)
+
+
+class StateOptions(typing.NamedTuple):
+    '''Locations of state kept between runs, None for default ones'''
+    manifest_path: typing.Optional[str] = None
+    store_path: typing.Optional[str] = None
+    cache_path: typing.Optional[str] = None
+    cache_ttl: float = CACHE_TTL
+    cache_size: int = CACHE_SIZE
+    use_cache: bool = True
+
+
+def open_state(image_downloader: ImageDownloader, basic_directory: str,
+               options: StateOptions) -> None:
+    '''Attach manifest, content store and page cache to downloader'''
+    image_downloader.manifest = Manifest(options.manifest_path or os.path.join(
+        basic_directory, STATE_DIRECTORY, 'manifest.sqlite3'))
+    if options.store_path:
+        image_downloader.store = ContentStore(options.store_path)
+    if options.use_cache:
+        image_downloader.page_cache = PageCache(
+            options.cache_path or os.path.join(
+                basic_directory, STATE_DIRECTORY, 'pages.sqlite3'),
+            options.cache_ttl * 24 * 3600, options.cache_size * 2 ** 20)
+
+
+def close_state(image_downloader: ImageDownloader) -> None:
+    '''Shut down downloader and close its state'''
+    image_downloader.close()
+    if image_downloader.manifest is not None:
+        image_downloader.manifest.close()
+    if image_downloader.page_cache is not None:
+        image_downloader.page_cache.close()
+
+
+async def download_units(image_downloader: ImageDownloader, work_queue: WorkQueue,
+                         worker: str, url: str, basic_directory: str) -> None:
+    '''Download months claimed from work queue until none is left, keep
+    leases of claimed months alive meanwhile'''
+    import asyncio
+
+    def claim():
+        while True:
+            unit = work_queue.claim(worker)
+            if unit is None:
+                return
+            year, month_number = unit
+            yield Month(str(month_number)), year
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(work_queue.lease / 3)
+            work_queue.heartbeat(worker)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        async for report in image_downloader.download_months(url, basic_directory, claim()):
+            if work_queue.complete(worker, report):
+                print_month_report(report)
+    finally:
+        heartbeat_task.cancel()
+
+
+def get_worker_name(pid: int) -> str:
+    '''Return name under which worker process with given pid claims units'''
+    import socket
+    return '{0}-{1}'.format(socket.gethostname(), pid)
+
+
+def run_worker(queue_path: str, lease: float, url: str, basic_directory: str,
+               downloader_options: typing.Mapping[str, typing.Any],
+               state_options: StateOptions) -> None:
+    '''Entry point of worker process: build downloader from given options
+    and download months from work queue'''
+    import asyncio
+    worker = get_worker_name(os.getpid())
+    image_downloader = ImageDownloader(**downloader_options)
+    work_queue = WorkQueue(queue_path, lease)
+    open_state(image_downloader, basic_directory, state_options)
+    try:
+        asyncio.run(download_units(image_downloader, work_queue, worker, url, basic_directory))
+    finally:
+        close_state(image_downloader)
+        work_queue.close()
+
+
+def download_sharded(queue_path: str, lease: float, workers: int,
+                     months: typing.Iterable[typing.Tuple[Month, int]], url: str,
+                     basic_directory: str, downloader_options: typing.Mapping[str, typing.Any],
+                     state_options: StateOptions) -> bool:
+    '''Queue months and download them by given number of worker processes,
+    return False if some months are left unfinished.
+
+    Workers on other machines may share the queue and base directory, each
+    month is downloaded by one of them into the usual month directory.
+    Months of crashed worker are queued again at once and a new worker is
+    started in its place.
+    '''
+    import multiprocessing
+    import multiprocessing.connection
+    work_queue = WorkQueue(queue_path, lease)
+    try:
+        work_queue.add((year, month.number) for month, year in months)
+        # Workers are spawned, so that they start with no state of this process
+        context = multiprocessing.get_context('spawn')
+
+        def start():
+            process = context.Process(target=run_worker, args=(
+                queue_path, lease, url, basic_directory, downloader_options, state_options))
+            process.start()
+            return process
+
+        processes = [start() for _ in range(workers)]
+        while processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+            for process in [process for process in processes if not process.is_alive()]:
+                processes.remove(process)
+                process.join()
+                # Worker which crashed holding no months is not replaced, so
+                # that worker failing at start is not restarted forever
+                if process.exitcode and work_queue.release(get_worker_name(process.pid)):
+                    print('Worker exited with code {}, its months are queued again.'.format(
+                        process.exitcode))
+                    processes.append(start())
+
+        counts = work_queue.get_counts()
+        units, found, downloaded = counts.get('done', (0, 0, 0))
+        print('\nCompleted {0} months, downloaded {1} of {2} images.'.format(
+            units, downloaded, found))
+        failures = work_queue.get_failures()
+        if failures:
+            print('Failed {} months:'.format(len(failures)))
+            for year, month, error in failures:
+                print('  {0} {1}: {2}'.format(calendar.month_name[month], year, error))
+        left = counts.get('claimed', (0,))[0] + counts.get('pending', (0,))[0]
+        if left:
+            print('{} months are left to other workers.'.format(left))
+        return not left
+    finally:
+        work_queue.close()
+
+
+class DefaultGroup(click.Group):
+    '''Group which runs default command unless name of other command is
+    given first, so that options of default command need no command name'''
+
+    def __init__(self, *args, default_command: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx: click.Context, args: typing.List[str]) -> typing.List[str]:
+        if not args or args[0] not in self.commands:
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+
+@click.command(epilog="Other commands: 'index' builds catalogue of wallpapers, "
+                      "'query' searches it. See '<command> --help'.")
+@click.option('-r', '--resolution', multiple=True,
+              help='Resolution, example: 1920x1080, can be given several times')
+@click.option('--all-resolutions', is_flag=True,
+              help='Download images in every resolution found on page')
 @click.option('-m', '--month',
-              help='Month, number or text format, example: 12 or December',
-              required=True)
-@click.option('-y', '--year', type=click.IntRange(2011, 2020),
-              help='Year between 2011 and 2020', required=True)
-def main(resolution, month, year):
+              help='Month, number or text format, example: 12 or December')
+@click.option('-y', '--year', type=click.IntRange(MIN_YEAR, MAX_YEAR),
+              help='Year between {0} and {1}'.format(MIN_YEAR, MAX_YEAR))
+@click.option('--from', 'date_from', type=YearMonth(),
+              help='First month of range, example: 2015-01')
+@click.option('--to', 'date_to', type=YearMonth(),
+              help='Last month of range, example: 2019-12')
+@click.option('--parser', type=click.Choice(PARSERS), default=PARSERS[0],
+              show_default=True, help='Engine for parsing page for image links')
+@click.option('--sync', is_flag=True,
+              help='Skip images which are unchanged since last download')
+@click.option('--manifest', 'manifest_path', type=click.Path(dir_okay=False),
+              help='Database of downloaded images, default: {}'.format(
+                  os.path.join(STATE_DIRECTORY, 'manifest.sqlite3')))
+@click.option('--store', 'store_path', type=click.Path(file_okay=False),
+              help='Content-addressed store, images in month directories '
+                   'become hardlinks to it')
+@click.option('--cache', 'cache_path', type=click.Path(dir_okay=False),
+              help='Cache of calendar pages, default: {}'.format(
+                  os.path.join(STATE_DIRECTORY, 'pages.sqlite3')))
+@click.option('--cache-ttl', type=click.FloatRange(0), default=CACHE_TTL,
+              show_default=True, help='Days before cached page is revalidated')
+@click.option('--cache-size', type=click.IntRange(1), default=CACHE_SIZE,
+              show_default=True, help='Size limit of page cache, in MB')
+@click.option('--no-cache', is_flag=True, help='Always fetch and parse calendar pages')
+@click.option('--concurrency', type=click.Choice(CONCURRENCY_POLICIES),
+              default=CONCURRENCY_POLICIES[0], show_default=True,
+              help='Policy limiting number of image requests in flight')
+@click.option('-c', '--connections', type=click.IntRange(1), default=5,
+              show_default=True,
+              help='Limit of requests in flight, initial one for adaptive policy')
+@click.option('--max-connections', type=click.IntRange(1), default=64,
+              show_default=True, help='Upper limit of requests in flight for adaptive policy')
+@click.option('--order', type=click.Choice(ORDERS), default=ORDERS[0],
+              show_default=True,
+              help='Order of downloading, by size within window of --queue-size images')
+@click.option('--queue-size', type=click.IntRange(1), default=256, show_default=True,
+              help='Number of images waiting in scheduler queue')
+@click.option('--chunk-size', type=click.IntRange(1), default=CHUNK_SIZE // 1024,
+              show_default=True, help='Size of blocks read and written to disk, in KiB')
+@click.option('--retries', type=click.IntRange(0), default=3, show_default=True,
+              help='Number of retries of failed request')
+@click.option('--backoff', type=click.FloatRange(0), default=0.5, show_default=True,
+              help='Base delay in seconds before retry, doubled on every attempt')
+@click.option('--limit-rate', type=Rate(), help='Limit of received bytes per second, '
+              'example: 500K or 2M')
+@click.option('--host-limit-rate', type=Rate(),
+              help='Limit of received bytes per second from one host')
+@click.option('--limit-requests', type=click.FloatRange(0),
+              help='Limit of requests per second, above zero')
+@click.option('--host-limit-requests', type=click.FloatRange(0),
+              help='Limit of requests per second to one host, above zero')
+@click.option('--burst', type=click.FloatRange(0), default=1.0, show_default=True,
+              help='Seconds of rate limit which may be used at once after idle time')
+@click.option('--limits-file', type=click.Path(dir_okay=False),
+              help="Control file of 'limit-rate = 1M' lines, reread when changed "
+                   'or on SIGHUP, overrides limit options')
+@click.option('--archive', 'archive_path', type=click.Path(dir_okay=False, allow_dash=True),
+              help="Stream images into archive instead of month directories, "
+                   "'-' for standard output")
+@click.option('--archive-format', type=click.Choice(ARCHIVE_FORMATS),
+              help='Format of archive, default: zip for .zip files, tar otherwise')
+@click.option('--archive-buffer', type=click.IntRange(1), default=4, show_default=True,
+              help='Data buffered by download waiting for its turn in archive, in MB')
+@click.option('-w', '--workers', type=click.IntRange(1),
+              help='Download months of range by number of processes')
+@click.option('--queue', 'queue_path', type=click.Path(dir_okay=False),
+              help='Work queue shared by workers, also on other machines with '
+                   'common filesystem; finished months are not downloaded again')
+@click.option('--lease', type=click.FloatRange(1), default=300, show_default=True,
+              help='Seconds before month of lost worker is claimed again')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False),
+              help='Write JSON report of run: stage timings, latency histograms, '
+                   'throughput, errors')
+@click.option('--prometheus', 'prometheus_path', type=click.Path(dir_okay=False),
+              help='Write report as Prometheus textfile')
+@click.pass_context
+def main(ctx, resolution, all_resolutions, month, year, date_from, date_to, parser, sync,
+         manifest_path, store_path, cache_path, cache_ttl, cache_size, no_cache,
+         concurrency, connections, max_connections, order,
+         queue_size, chunk_size, retries, backoff, limit_rate, host_limit_rate,
+         limit_requests, host_limit_requests, burst, limits_file, archive_path, archive_format,
+         archive_buffer, workers, queue_path, lease,
+         report_path, prometheus_path):
     '''Program for downloading files from 'www.smashingmagazine.com"'''
+    # Either resolutions or --all-resolutions must be given
+    if not resolution and not all_resolutions:
+        raise click.MissingParameter(ctx=ctx, param=_get_param(ctx, 'resolution'))
+    if resolution and all_resolutions:
+        raise click.UsageError(
+            'Option --resolution can not be used with --all-resolutions', ctx=ctx)
+
+    # Either single month (--month and --year) or range (--from and --to)
+    # must be given
+    range_mode = date_from is not None or date_to is not None
+    if range_mode:
+        for name, value in (('date_from', date_from), ('date_to', date_to)):
+            if value is None:
+                raise click.MissingParameter(ctx=ctx, param=_get_param(ctx, name))
+        if month is not None or year is not None:
+            raise click.UsageError(
+                'Options --month/--year can not be used with --from/--to', ctx=ctx)
+        if date_from > date_to:
+            raise click.BadParameter(
+                'must not be later than --to', ctx=ctx, param=_get_param(ctx, 'date_from'))
+    else:
+        for name, value in (('month', month), ('year', year)):
+            if value is None:
+                raise click.MissingParameter(ctx=ctx, param=_get_param(ctx, name))
+
+    # Range can be split between worker processes sharing work queue
+    sharded = workers is not None or queue_path is not None
+    if sharded and not range_mode:
+        raise click.UsageError('Options --workers/--queue require --from/--to', ctx=ctx)
+    if sharded and (report_path or prometheus_path):
+        raise click.UsageError(
+            'Options --report/--prometheus can not be used with --workers/--queue', ctx=ctx)
+    if archive_path and (sharded or sync or store_path):
+        raise click.UsageError(
+            'Option --archive can not be used with --workers/--queue, --sync or --store',
+            ctx=ctx)
+    # Zero requests per second would stop downloading for good
+    for name, value in (('limit_requests', limit_requests),
+                        ('host_limit_requests', host_limit_requests)):
+        if value == 0:
+            raise click.BadParameter('must be positive', ctx=ctx, param=_get_param(ctx, name))
+
     # Validating values given to Month and ImangeDownloader
     try:
-        month_obj = Month(month)
-        image_downloader = ImageDownloader(resolution)
+        month_obj = Month(month) if not range_mode else None
+        if concurrency == 'adaptive':
+            concurrency_policy = AdaptiveConcurrency(
+                connections, maximum=max(connections, max_connections))
+        else:
+            concurrency_policy = FixedConcurrency(connections)
+        downloader_options = dict(
+            resolution=resolution or None, parser=parser, sync=sync,
+            concurrency=concurrency_policy, retry=RetryPolicy(retries + 1, backoff),
+            order=order, queue_size=queue_size, chunk_size=chunk_size * 1024,
+            limiter=RateLimiter(limit_rate, limit_requests, host_limit_rate,
+                                host_limit_requests, burst))
+        image_downloader = ImageDownloader(**downloader_options)
     except ValueError as err:
         message, value = err.args
         print('{0}: {1}'.format(message, value))
         return
 
+    # Released when context of command is closed
+    resources = contextlib.ExitStack()
+    ctx.call_on_close(resources.close)
+    if archive_path == '-':
+        # Standard output carries archive, messages go to standard error
+        archive_stream = sys.stdout.buffer
+        resources.enter_context(contextlib.redirect_stdout(sys.stderr))
     print('Trying to establish connection...')
 
-    # Getting url link in expected format
-    url = image_downloader.get_url(URL, month_obj.number, month_obj.name, year)
+    if limits_file:
+        downloader_options['limiter'].watch(limits_file)
+    state_options = StateOptions(
+        manifest_path, store_path, cache_path, cache_ttl, cache_size, not no_cache)
+    if sharded:
+        # Without shared queue, the queue lives as long as this run
+        temporary_queue = queue_path is None
+        queue_path = queue_path or os.path.join(
+            BASE_DIR, STATE_DIRECTORY, 'queue-{}.sqlite3'.format(os.getpid()))
+        finished = download_sharded(
+            queue_path, lease, workers or 1, iter_months(date_from, date_to),
+            URL, BASE_DIR, downloader_options, state_options)
+        if temporary_queue:
+            if finished:
+                os.remove(queue_path)
+            else:
+                # Queue with unfinished months is kept, so that they are not lost
+                print('Resume with --queue={}'.format(queue_path))
+        return
+
+    import asyncio
+    import json
+    open_state(image_downloader, BASE_DIR, state_options)
+    if archive_path:
+        if archive_path != '-':
+            archive_stream = resources.enter_context(open(archive_path, 'wb'))
+        if archive_format is None:
+            archive_format = 'zip' if archive_path.lower().endswith('.zip') else 'tar'
+        writer = ZipArchiveWriter if archive_format == 'zip' else TarArchiveWriter
+        image_downloader.archive = ArchiveStream(
+            writer(archive_stream), BASE_DIR, archive_buffer * 2 ** 20,
+            image_downloader.io_executor)
+
+    async def run():
+        try:
+            if range_mode:
+                await download_range(image_downloader, iter_months(date_from, date_to))
+            else:
+                await download_month(image_downloader, month_obj, year)
+        finally:
+            if image_downloader.archive is not None:
+                await image_downloader.archive.close()
+                print('Written {} images to archive.'.format(image_downloader.archive.count))
+
+    try:
+        asyncio.run(run())
+    finally:
+        report = image_downloader.metrics.get_report(image_downloader)
+        if report_path:
+            write_report(report_path, json.dumps(report, indent=2) + '\n')
+        if prometheus_path:
+            write_report(prometheus_path, format_prometheus(report))
+        close_state(image_downloader)
+
+
+@click.group(cls=DefaultGroup, default_command='download')
+def cli():
+    '''Program for downloading files from 'www.smashingmagazine.com"'''
+
+
+cli.add_command(main, 'download')
+
+
+@cli.command()
+@click.option('--from', 'date_from', type=YearMonth(), default='{}-01'.format(MIN_YEAR),
+              show_default=True, help='First month to index')
+@click.option('--to', 'date_to', type=YearMonth(), default='{}-12'.format(MAX_YEAR),
+              show_default=True, help='Last month to index')
+@click.option('--catalogue', 'catalogue_path', type=click.Path(dir_okay=False),
+              help='Catalogue database, default: {}'.format(
+                  os.path.join(STATE_DIRECTORY, 'catalogue.sqlite3')))
+@click.option('--sizes', is_flag=True,
+              help='Request sizes of images not in manifest with HEAD requests')
+@click.option('--parser', type=click.Choice(PARSERS), default=PARSERS[0],
+              show_default=True, help='Engine for parsing page for image links')
+@click.option('--no-cache', is_flag=True, help='Always fetch and parse calendar pages')
+@click.option('-c', '--connections', type=click.IntRange(1), default=5,
+              show_default=True, help='Limit of HEAD requests in flight')
+def index(date_from, date_to, catalogue_path, sizes, parser, no_cache, connections):
+    '''Crawl calendar pages of range once and index wallpapers of every
+    resolution'''
+    import asyncio
+    if date_from > date_to:
+        raise click.BadParameter('must not be later than --to', param_hint="'--from'")
+    image_downloader = ImageDownloader(
+        None, parser, concurrency=FixedConcurrency(connections))
+    open_state(image_downloader, BASE_DIR, StateOptions(use_cache=not no_cache))
+    catalogue = Catalogue(catalogue_path or os.path.join(
+        BASE_DIR, STATE_DIRECTORY, 'catalogue.sqlite3'))
+
+    async def crawl():
+        async with image_downloader.create_session() as session:
+            for month, year in iter_months(date_from, date_to):
+                try:
+                    entries = await image_downloader.index_month(
+                        session, URL, month, year, sizes)
+                except Exception as err:
+                    print('{0} {1}: {2}'.format(month.name, year, err))
+                    continue
+                catalogue.replace_month(year, month.number, entries)
+                print('{0} {1}: {2} wallpapers.'.format(month.name, year, len(entries)))
 
-    # Making GET request, createing storage directory for images,
-    # parsing html page for image links with given parameters
     try:
-        content = image_downloader.fetch_content(url, timeout=5)
-        storage_path = image_downloader.create_directory(
-            BASE_DIR, month_obj.name, year)
-    except Exception as err:
-        print(err)
-        return
-    else:
-        image_links = image_downloader.get_image_links(content)
-        if not image_links:
-            print('Unable to download images with given parameters.')
-            return
+        asyncio.run(crawl())
+        print('Catalogue has {} wallpapers.'.format(catalogue.count()))
+    finally:
+        close_state(image_downloader)
+        catalogue.close()
 
-    print('Connection established, start downloading...')
 
-    # Asynchronously downloading images
-    downloaded_image_count = asyncio.run(
-        image_downloader.download_all(storage_path, image_links))
+@cli.command()
+@click.option('-r', '--resolution', multiple=True,
+              help='Resolution, example: 3840x2160, can be given several times')
+@click.option('-y', '--year', type=click.IntRange(MIN_YEAR, MAX_YEAR), multiple=True,
+              help='Year, can be given several times')
+@click.option('-m', '--month', multiple=True,
+              help='Month, number or text format, can be given several times')
+@click.option('--variant', type=click.Choice(('cal', 'nocal')),
+              help='Wallpapers with or without calendar')
+@click.option('--design', help='Part of design name')
+@click.option('--min-width', type=click.IntRange(1), help='Smallest width')
+@click.option('--min-height', type=click.IntRange(1), help='Smallest height')
+@click.option('--catalogue', 'catalogue_path', type=click.Path(dir_okay=False),
+              help='Catalogue database, default: {}'.format(
+                  os.path.join(STATE_DIRECTORY, 'catalogue.sqlite3')))
+@click.option('-l', '--long', 'long_format', is_flag=True,
+              help='Print year, month, design, variant, resolution and size of '
+                   'every wallpaper before its url')
+@click.option('--download', 'download_path', type=click.Path(file_okay=False),
+              help='Download matching wallpapers into given directory')
+def query(resolution, year, month, variant, design, min_width, min_height,
+          catalogue_path, long_format, download_path):
+    '''Print urls of wallpapers in catalogue matching every given condition,
+    example: query -r 3840x2160 -y 2018 --variant nocal'''
+    try:
+        resolutions = [ImageDownloader.validate_input(value) for value in resolution]
+        months = [Month(value).number for value in month]
+    except ValueError as err:
+        message, value = err.args
+        print('{0}: {1}'.format(message, value))
+        return
+    catalogue_path = catalogue_path or os.path.join(
+        BASE_DIR, STATE_DIRECTORY, 'catalogue.sqlite3')
+    if not os.path.exists(catalogue_path):
+        raise click.ClickException(
+            "Catalogue {} does not exist, build it with 'index' command".format(catalogue_path))
+    catalogue = Catalogue(catalogue_path)
+    try:
+        entries = catalogue.query(resolutions, year, months, variant, design,
+                                  min_width, min_height)
+    finally:
+        catalogue.close()
 
-    if downloaded_image_count:
-        print('\nDownload complete. Downloaded {} images.'.format(downloaded_image_count))
-    else:
-        print('Undefined issues occurred while attempting to download images.')
+    for entry in entries:
+        if long_format:
+            print('\t'.join(str(value) if value is not None else '-' for value in entry))
+        else:
+            print(entry.url)
+    if download_path:
+        import asyncio
+        os.makedirs(download_path, exist_ok=True)
+        image_downloader = ImageDownloader(None)
+        open_state(image_downloader, BASE_DIR, StateOptions(use_cache=False))
+        try:
+            asyncio.run(image_downloader.download_all(
+                download_path, [entry.url for entry in entries]))
+        finally:
+            close_state(image_downloader)
+        print_summary(image_downloader)
 
 
 if __name__ == '__main__':
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     URL = 'www.smashingmagazine.com'
-    main()
+    cli()
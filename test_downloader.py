@@ -1,8 +1,35 @@
+import os
+import re
+import sys
+import time
+import hashlib
+import sqlite3
+import collections
+import asyncio
+import io
+import tarfile
+import zipfile
+import tempfile
 import unittest
+import signal
+import subprocess
+import multiprocessing
 from unittest import mock
 from click.testing import CliRunner
-import requests
-from downloader import main, Month, ImageDownloader
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer, unused_port
+from downloader import (
+    main, cli, Month, ImageDownloader, DownloadResult, Manifest, ManifestEntry,
+    ContentStore, PageCache, TokenBucket, RateLimiter, parse_rate, ArchiveStream,
+    TarArchiveWriter, ZipArchiveWriter, Metrics, WorkQueue, Catalogue, CatalogueEntry,
+    parse_wallpaper_link, MonthReport, format_prometheus, download_units,
+    download_sharded, get_worker_name, StateOptions,
+    FixedConcurrency, AdaptiveConcurrency, RetryPolicy, CircuitBreaker,
+    CircuitOpenError, iter_months, link_file, open_part_file,
+    sniff_image_type, PARSERS
+)
+from benchmark import make_page
 
 
 class MissingInputTests(unittest.TestCase):
@@ -91,6 +118,38 @@ class InvalidInputTests(unittest.TestCase):
                               result.output)
                 self.assertEqual(2, result.exit_code)
 
+    def test_invalid_range_input(self):
+        '''Ensure if we can't launch program with invalid range input'''
+        test_cases = [
+            ('-r 1280x1024 --from 2015-01', "Missing option '--to'"),
+            ('-r 1280x1024 --to 2015-01', "Missing option '--from'"),
+            ('-r 1280x1024 --from 2015 --to 2016-01', 'not in YYYY-MM format'),
+            ('-r 1280x1024 --from 2010-12 --to 2016-01', 'is not between'),
+            ('-r 1280x1024 --from 2015-13 --to 2016-01', 'Month 13 is not valid'),
+            ('-r 1280x1024 --from 2016-02 --to 2016-01', 'must not be later'),
+            ('-r 1280x1024 -m May --from 2015-01 --to 2016-01', 'can not be used'),
+        ]
+        for x, message in test_cases:
+            with self.subTest(x=x):
+                result = self.runner.invoke(main, x.split())
+                self.assertIn('Error', result.output)
+                self.assertIn(message, result.output)
+                self.assertEqual(2, result.exit_code)
+
+    def test_invalid_limit_input(self):
+        '''Ensure if we can't launch program with zero or negative limit of
+        requests'''
+        test_cases = [
+            ('-r 1280x1024 -m 5 -y 2019 --limit-requests 0', 'must be positive'),
+            ('-r 1280x1024 -m 5 -y 2019 --host-limit-requests 0', 'must be positive'),
+            ('-r 1280x1024 -m 5 -y 2019 --limit-requests -1', 'Invalid value'),
+        ]
+        for x, message in test_cases:
+            with self.subTest(x=x):
+                result = self.runner.invoke(main, x.split())
+                self.assertIn(message, result.output)
+                self.assertEqual(2, result.exit_code)
+
 
 class ValidInputTests(unittest.TestCase):
     runner = CliRunner()
@@ -122,7 +181,7 @@ class ValidInputTests(unittest.TestCase):
                 )
                 self.assertIn('Trying to establish connection...', result.output)
 
-    @mock.patch.object(ImageDownloader, 'fetch_content')
+    @mock.patch.object(ImageDownloader, 'fetch_content', return_value='')
     def test_fetch_valid_input(self, mock_fetch):
         '''Ensure if we can get valid url with valid input data'''
         url = 'http://someurl.com/test'
@@ -134,23 +193,19 @@ class ValidInputTests(unittest.TestCase):
             '-r 1920x1080 -m December -y 2019',
         ]
         for x in test_cases:
-            with self.subTest(x=x):
-                self.runner.invoke(main, x.split(), input='3')
+            with self.subTest(x=x), tempfile.TemporaryDirectory() as base_dir, \
+                    mock.patch('downloader.URL', url, create=True), \
+                    mock.patch('downloader.BASE_DIR', base_dir, create=True):
+                result = self.runner.invoke(main, x.split() + ['--no-cache'], input='3')
                 _, res, _, month, _, year = x.split()
                 month = Month(month)
-                # image_downloader = ImageDownloader(
-                #     url, month.number, month.name, int(year))
 
                 new_url = ImageDownloader(base_resolution).get_url(
                     url, month.number, month.name, int(year))
 
-                self.assertTrue(
-                    # ImageDownloader.get_url.called_with(
-                    mock_fetch.called_with(
-                        new_url,
-                        timeout=5
-                    )
-                )
+                mock_fetch.assert_awaited_with(mock.ANY, new_url, timeout=mock.ANY)
+                self.assertIn('Unable to download images with given parameters.',
+                              result.output)
 
 
 class MonthClassTests(unittest.TestCase):
@@ -225,50 +280,50 @@ class ImageDownloaderClassTests(unittest.TestCase):
             with self.subTest(x=x):
                 self.assertEqual(image_downloader.get_url(*x), exp_output)
 
-    def mocked_requests_get(*args, **kwargs):
-        '''Mocking for request.get'''
-        class MockResponse:
-            def __init__(self, content, status_code):
-                self.content = content
-                self.status_code = status_code
-
-            def raise_for_status(self):
-                if self.status_code != 200:
-                    raise requests.HTTPError()
-                return self.status_code
-
-        if args[0] == 'http://someurl.com/test':
-            return MockResponse('some_data', 200)
-        elif args[0] == 'http://someotherurl.com/test':
-            return MockResponse('other_data', 200)
-        elif args[0] == 'http://nonexistenturl.com/test':
-            return MockResponse(None, 404)
-        elif args[0] == 'http://unabletoconnecturl.com/test':
-            raise requests.Timeout()
-        raise requests.RequestException()
-
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
-    def test_fetching_content(self, mock_get):
+    def test_fetching_content(self):
         '''Ensure if ImageDownloader object can make valid request'''
-        image_downloader = ImageDownloader(self.base_resolution)
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(base_delay=0))
+
+        async def some(request):
+            return web.Response(body=b'some_data')
+
+        async def other(request):
+            return web.Response(body=b'other_data')
 
-        resp = image_downloader.fetch_content('http://someurl.com/test')
-        self.assertEqual(resp, 'some_data')
+        async def slow(request):
+            await asyncio.sleep(1)
+            return web.Response(body=b'late_data')
 
-        resp = image_downloader.fetch_content('http://someotherurl.com/test')
-        self.assertEqual(resp, 'other_data')
+        app = web.Application()
+        app.router.add_get('/test', some)
+        app.router.add_get('/other', other)
+        app.router.add_get('/slow', slow)
 
-        with self.assertRaises(Exception) as err:
-            image_downloader.fetch_content('http://nonexistenturl.com/test')
-        self.assertIn('Error', err.exception.args[0])
+        async def fetch(server, session, path, **kwargs):
+            return await image_downloader.fetch_content(
+                session, str(server.make_url(path)), **kwargs)
 
-        with self.assertRaises(Exception) as err:
-            image_downloader.fetch_content('http://unabletoconnecturl.com/test')
-        self.assertIn('Connection timed out', err.exception.args)
+        async def run():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                self.assertEqual(await fetch(server, session, '/test'), b'some_data')
+                self.assertEqual(await fetch(server, session, '/other'), b'other_data')
 
-        with self.assertRaises(Exception) as err:
-            image_downloader.fetch_content('http://otherunknownurl.com/test')
-        self.assertIn('Unable to establish connection', err.exception.args)
+                with self.assertRaises(Exception) as err:
+                    await fetch(server, session, '/nonexistent')
+                self.assertIn('Error 404', err.exception.args)
+
+                with self.assertRaises(Exception) as err:
+                    await fetch(server, session, '/slow',
+                                timeout=aiohttp.ClientTimeout(total=0.1))
+                self.assertIn('Connection timed out', err.exception.args)
+
+                with self.assertRaises(Exception) as err:
+                    await image_downloader.fetch_content(
+                        session, 'http://127.0.0.1:1/test')
+                self.assertIn('Unable to establish connection', err.exception.args)
+
+        asyncio.run(run())
 
     def test_getting_image_links(self):
         '''Ensure if ImageDownloader object can return links from html content'''
@@ -292,12 +347,34 @@ title="Hello Spring! - 1024x768">1024x768</a>'''
             )
         ]
         for resolution, exp_output in test_cases:
-            with self.subTest(x=resolution):
+            for parser in PARSERS:
+                with self.subTest(x=resolution, parser=parser):
+                    self.assertEqual(
+                        ImageDownloader(resolution, parser).get_image_links(
+                            response_content),
+                        exp_output
+                    )
+
+    def test_parsers_return_same_links(self):
+        '''Ensure if streaming parser finds the same links as BeautifulSoup'''
+        test_cases = [
+            make_page(3),
+            b'<a href="a">800x<b>480</b></a><a>800x480</a><a href="b"> 800x480</a>',
+            b'<a href="a">800x480<a href="b">800x480</a></a><p>800x480</p>',
+            b'<meta charset="utf-8"><a href="\xc3\xa9">800<!-- -->x480</a>',
+            b'',
+        ]
+        for content in test_cases:
+            with self.subTest(x=content[:40]):
                 self.assertEqual(
-                    ImageDownloader(resolution).get_image_links(response_content),
-                    exp_output
+                    ImageDownloader('800x480', 'stream').get_image_links(content),
+                    ImageDownloader('800x480', 'soup').get_image_links(content)
                 )
 
+    def test_parser_invalid_value(self):
+        '''Ensure if we can't create ImageDownloader object with unknown parser'''
+        self.assertRaises(ValueError, ImageDownloader, '800x480', 'regex')
+
     @mock.patch('downloader.os')
     def test_creating_directory(self, mock_os):
         '''Ensure if ImageDownloader object can create directory'''
@@ -315,5 +392,1348 @@ title="Hello Spring! - 1024x768">1024x768</a>'''
         )
 
 
+
+class MultiResolutionTests(unittest.TestCase):
+    response_content = '''
+        <a href=cal-800x480.png>800x480</a>, <a href=cal-1024x768.png>1024x768</a>
+        <a href=nocal-800x480.png>800x480</a>, <a href=nocal-1024x768.png>1024x768</a>
+        <a href=nocal-1920x1080.png>1920x1080</a> <a href=preview.png>Preview</a>'''
+
+    def test_link_index(self):
+        '''Ensure if links of several resolutions are grouped in one pass'''
+        test_cases = [
+            (
+                ['1024x768', '800x480'],
+                {
+                    '800x480': ['cal-800x480.png', 'nocal-800x480.png'],
+                    '1024x768': ['cal-1024x768.png', 'nocal-1024x768.png'],
+                }
+            ),
+            (
+                None,
+                {
+                    '800x480': ['cal-800x480.png', 'nocal-800x480.png'],
+                    '1024x768': ['cal-1024x768.png', 'nocal-1024x768.png'],
+                    '1920x1080': ['nocal-1920x1080.png'],
+                }
+            ),
+        ]
+        for resolutions, exp_output in test_cases:
+            for parser in PARSERS:
+                with self.subTest(x=resolutions, parser=parser):
+                    image_downloader = ImageDownloader(resolutions, parser)
+                    self.assertIsNone(image_downloader.resolution)
+                    index = image_downloader.get_link_index(self.response_content)
+                    self.assertEqual(index, exp_output)
+                    self.assertEqual(list(index), list(exp_output))
+
+    def test_invalid_resolutions(self):
+        '''Ensure if every resolution of sequence is validated'''
+        self.assertRaises(ValueError, ImageDownloader, ['800x480', '64x48'])
+        self.assertRaises(ValueError, ImageDownloader, [])
+        self.assertEqual(ImageDownloader(['800x480', '800x480']).resolution, '800x480')
+
+    def test_targets(self):
+        '''Ensure if images of several resolutions get own subdirectories'''
+        image_downloader = ImageDownloader(['800x480', '1920x1080'])
+        index = image_downloader.get_link_index(self.response_content)
+        with tempfile.TemporaryDirectory() as storage_path:
+            targets = image_downloader.get_targets(storage_path, index)
+            self.assertEqual(targets, [
+                (os.path.join(storage_path, '800x480'), 'cal-800x480.png'),
+                (os.path.join(storage_path, '800x480'), 'nocal-800x480.png'),
+                (os.path.join(storage_path, '1920x1080'), 'nocal-1920x1080.png'),
+            ])
+            self.assertTrue(os.path.isdir(os.path.join(storage_path, '1920x1080')))
+
+        image_downloader = ImageDownloader('800x480')
+        self.assertEqual(image_downloader.get_targets('/', index), [
+            ('/', 'cal-800x480.png'), ('/', 'nocal-800x480.png')])
+
+    def test_resolution_options(self):
+        '''Ensure if resolutions and --all-resolutions are mutually exclusive'''
+        result = CliRunner().invoke(
+            main, '-r 800x480 --all-resolutions -m May -y 2019'.split())
+        self.assertIn('can not be used with --all-resolutions', result.output)
+        self.assertEqual(2, result.exit_code)
+
+        result = CliRunner().invoke(main, '-r 800x480 -r 64x48 -m May -y 2019'.split())
+        self.assertIn('Resolution value is not valid: 64x48', result.output)
+
+
+class DateRangeTests(unittest.TestCase):
+    base_resolution = '640x480'
+
+    def test_iter_months(self):
+        '''Ensure if months of range are generated in order, across years'''
+        months = [(month.number, year)
+                  for month, year in iter_months((2015, 11), (2016, 2))]
+        self.assertEqual(months, [(11, 2015), (12, 2015), (1, 2016), (2, 2016)])
+        self.assertEqual(list(iter_months((2016, 2), (2015, 11))), [])
+
+    def test_download_months(self):
+        '''Ensure if next month page is prepared while current month downloads'''
+        image_downloader = ImageDownloader(self.base_resolution)
+        events = []
+
+        async def prepare_month(session, url, basic_directory, month, year):
+            events.append(('prepare', month.number))
+            if month.number == 2:
+                raise Exception('Error 404')
+            return [('dir{}'.format(month.number), link) for link in ('a', 'b')]
+
+        async def download_targets(session, targets):
+            storage_path = targets[0][0]
+            events.append(('start', storage_path))
+            await asyncio.sleep(0.05)
+            events.append(('end', storage_path))
+            return len(targets) - 1
+
+        async def collect():
+            return [report async for report in image_downloader.download_months(
+                'abc.com', '/', iter_months((2015, 1), (2015, 3)))]
+
+        with mock.patch.object(image_downloader, 'prepare_month', prepare_month), \
+                mock.patch.object(image_downloader, 'download_targets', download_targets):
+            reports = asyncio.run(collect())
+
+        self.assertEqual(
+            [(r.month.number, r.found, r.downloaded, r.error) for r in reports],
+            [(1, 2, 1, None), (2, 0, 0, 'Error 404'), (3, 2, 1, None)]
+        )
+        self.assertLess(events.index(('prepare', 2)), events.index(('end', 'dir1')))
+
+
+
+class DownloadTestCase(unittest.TestCase):
+    '''Base class for tests downloading image from local server'''
+    base_resolution = '640x480'
+    image = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 400
+    etag = '"v1"'
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.storage_path = temp_dir.name
+        self.image_path = os.path.join(self.storage_path, 'image.png')
+        self.requests = []
+        self.port = unused_port()
+
+    def make_app(self, support_range=True, truncate_at=None):
+        '''Create application serving test image'''
+        async def image(request):
+            self.requests.append(request.headers.get('Range'))
+            if request.headers.get('If-None-Match') == self.etag:
+                return web.Response(status=304)
+            match = re.search(r'^bytes=(\d+)-$', request.headers.get('Range', ''))
+            if support_range and match:
+                start = int(match.group(1))
+                if start >= len(self.image):
+                    return web.Response(status=416)
+                return web.Response(status=206, body=self.image[start:], headers={
+                    'Content-Range': 'bytes {0}-{1}/{2}'.format(
+                        start, len(self.image) - 1, len(self.image))})
+            if truncate_at is None:
+                return web.Response(body=self.image, headers={'ETag': self.etag})
+            response = web.StreamResponse(headers={
+                'Content-Length': str(len(self.image))})
+            await response.prepare(request)
+            await response.write(self.image[:truncate_at])
+            await asyncio.sleep(0.1)
+            request.transport.close()
+            return response
+
+        app = web.Application()
+        app.router.add_get('/image.png', image)
+        return app
+
+    def download(self, app, image_downloader=None, storage_path=None):
+        '''Download test image from given application'''
+        image_downloader = image_downloader or ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(1))
+
+        async def run():
+            async with TestServer(app, port=self.port) as server, \
+                    aiohttp.ClientSession() as session:
+                return await image_downloader.download_image(
+                    session, storage_path or self.storage_path,
+                    str(server.make_url('/image.png')))
+
+        return asyncio.run(run())
+
+    def write_part(self, content):
+        with open(self.image_path + '.part', 'wb') as f:
+            f.write(content)
+
+    def assert_downloaded(self):
+        with open(self.image_path, 'rb') as f:
+            self.assertEqual(f.read(), self.image)
+        self.assertFalse(os.path.exists(self.image_path + '.part'))
+
+
+class ResumableDownloadTests(DownloadTestCase):
+    def test_download_without_part_file(self):
+        '''Ensure if image is downloaded whole and part file is renamed'''
+        self.assertTrue(self.download(self.make_app()))
+        self.assert_downloaded()
+        self.assertEqual(self.requests, [None])
+
+    def test_resume_part_file(self):
+        '''Ensure if only missing bytes are requested for existing part file'''
+        self.write_part(self.image[:1000])
+        self.assertTrue(self.download(self.make_app()))
+        self.assert_downloaded()
+        self.assertEqual(self.requests, ['bytes=1000-'])
+
+    def test_resume_part_file_shorter_than_signature(self):
+        '''Ensure if image type is recognized from part file and the rest
+        of image together'''
+        self.write_part(self.image[:4])
+        self.assertTrue(self.download(self.make_app()))
+        self.assert_downloaded()
+        self.assertEqual(self.requests, ['bytes=4-'])
+
+    def test_server_ignores_range(self):
+        '''Ensure if image is downloaded from scratch on 200 response'''
+        self.write_part(b'x' * 1000)
+        self.assertTrue(self.download(self.make_app(support_range=False)))
+        self.assert_downloaded()
+
+    def test_part_file_too_long(self):
+        '''Ensure if image is downloaded from scratch on 416 response'''
+        self.write_part(self.image + b'x')
+        self.assertTrue(self.download(self.make_app()))
+        self.assert_downloaded()
+        self.assertEqual(self.requests, ['bytes={}-'.format(len(self.image) + 1), None])
+
+    def test_chunk_sizes(self):
+        '''Ensure if image is written correctly whatever the size of blocks'''
+        for chunk_size in (1000, 4096, 10 ** 6):
+            with self.subTest(x=chunk_size):
+                image_downloader = ImageDownloader(
+                    self.base_resolution, retry=RetryPolicy(1), chunk_size=chunk_size)
+                self.assertTrue(self.download(self.make_app(), image_downloader))
+                image_downloader.close()
+                self.assert_downloaded()
+
+    def test_part_file_is_not_preallocated(self):
+        '''Ensure if part file holds only written bytes, so that it can be
+        resumed after crash'''
+        part_path = self.image_path + '.part'
+        self.write_part(b'x' * 10)
+        f = open_part_file(part_path, 10)
+        self.assertEqual(os.path.getsize(part_path), 10)
+        f.write(b'y' * 20)
+        f.flush()
+        self.assertEqual(os.path.getsize(part_path), 30)
+        f.close()
+        with open(part_path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 10 + b'y' * 20)
+
+    def test_interrupted_download(self):
+        '''Ensure if interrupted download keeps part file for the next run'''
+        self.assertFalse(self.download(self.make_app(
+            support_range=False, truncate_at=5000)))
+        self.assertFalse(os.path.exists(self.image_path))
+        self.assertEqual(os.path.getsize(self.image_path + '.part'), 5000)
+
+        self.assertTrue(self.download(self.make_app()))
+        self.assert_downloaded()
+        self.assertEqual(self.requests[-1], 'bytes=5000-')
+
+
+
+class SyncTests(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manifest = Manifest(os.path.join(self.storage_path, 'state', 'm.sqlite3'))
+        self.addCleanup(self.manifest.close)
+
+    def make_downloader(self, sync=True):
+        return ImageDownloader(self.base_resolution, manifest=self.manifest,
+                               sync=sync, retry=RetryPolicy(1))
+
+    def test_download_is_recorded(self):
+        '''Ensure if downloaded image is recorded in manifest'''
+        self.assertTrue(self.download(self.make_app(), self.make_downloader(False)))
+        entry = self.manifest.get('http://127.0.0.1:{}/image.png'.format(self.port))
+        self.assertEqual(entry.path, os.path.abspath(self.image_path))
+        self.assertEqual(entry.size, len(self.image))
+        self.assertEqual(entry.etag, self.etag)
+
+    def test_unchanged_image_is_skipped(self):
+        '''Ensure if unchanged image costs only conditional request'''
+        self.download(self.make_app(), self.make_downloader())
+        image_downloader = self.make_downloader()
+        self.assertTrue(self.download(self.make_app(), image_downloader))
+        self.assertEqual(image_downloader.stats, {'unchanged': 1})
+        self.assert_downloaded()
+
+    def test_changed_image_is_downloaded(self):
+        '''Ensure if image changed on server is downloaded again'''
+        self.download(self.make_app(), self.make_downloader())
+        self.etag, self.image = '"v2"', self.image[:8] + self.image[:7:-1]
+        image_downloader = self.make_downloader()
+        self.assertTrue(self.download(self.make_app(), image_downloader))
+        self.assertEqual(image_downloader.stats, {'downloaded': 1})
+        self.assert_downloaded()
+
+    def test_modified_local_file_is_downloaded(self):
+        '''Ensure if image with size differing from manifest is downloaded again'''
+        self.download(self.make_app(), self.make_downloader())
+        with open(self.image_path, 'ab') as f:
+            f.write(b'x')
+        image_downloader = self.make_downloader()
+        self.assertTrue(self.download(self.make_app(), image_downloader))
+        self.assertEqual(image_downloader.stats, {'downloaded': 1})
+        self.assert_downloaded()
+
+
+
+class IntegrityTests(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manifest = Manifest(os.path.join(self.storage_path, 'state', 'm.sqlite3'))
+        self.addCleanup(self.manifest.close)
+        self.image_downloader = ImageDownloader(
+            self.base_resolution, manifest=self.manifest, retry=RetryPolicy(1))
+
+    def recorded_digest(self):
+        return self.manifest.get(
+            'http://127.0.0.1:{}/image.png'.format(self.port)).sha256
+
+    def test_digest_is_recorded(self):
+        '''Ensure if digest computed on stream is recorded in manifest'''
+        self.assertTrue(self.download(self.make_app(), self.image_downloader))
+        self.assertEqual(self.recorded_digest(), hashlib.sha256(self.image).hexdigest())
+
+    def test_digest_of_resumed_download(self):
+        '''Ensure if digest of resumed download covers the whole image'''
+        self.write_part(self.image[:3000])
+        self.assertTrue(self.download(self.make_app(), self.image_downloader))
+        self.assertEqual(self.requests, ['bytes=3000-'])
+        self.assertEqual(self.recorded_digest(), hashlib.sha256(self.image).hexdigest())
+
+    def test_error_page_is_rejected(self):
+        '''Ensure if HTML page served with 200 is not kept as image'''
+        self.image = b'<html><body>Service unavailable</body></html>'
+        self.assertFalse(self.download(self.make_app(), self.image_downloader))
+        self.assertFalse(os.path.exists(self.image_path))
+        self.assertFalse(os.path.exists(self.image_path + '.part'))
+        self.assertEqual(self.image_downloader.failures[0][1],
+                         'Downloaded content is not an image')
+
+    def test_sniff_image_type(self):
+        '''Ensure if image types are recognized by magic bytes'''
+        test_cases = [
+            (b'\x89PNG\r\n\x1a\n\x00\x00', 'png'),
+            (b'\xff\xd8\xff\xe0\x00\x10JFIF', 'jpeg'),
+            (b'GIF89a\x01\x00', 'gif'),
+            (b'RIFF\x00\x00\x00\x00WEBP', 'webp'),
+            (b'<!DOCTYPE html>', None),
+            (b'', None),
+        ]
+        for head, exp_output in test_cases:
+            with self.subTest(x=head):
+                self.assertEqual(sniff_image_type(head), exp_output)
+
+    def test_manifest_without_digests(self):
+        '''Ensure if manifest created before digests were recorded is upgraded'''
+        path = os.path.join(self.storage_path, 'old.sqlite3')
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(
+                'CREATE TABLE images (url TEXT PRIMARY KEY, path TEXT NOT NULL, '
+                'size INTEGER NOT NULL, etag TEXT, last_modified TEXT)')
+            connection.execute("INSERT INTO images VALUES ('a', '/a', 1, NULL, NULL)")
+        connection.close()
+
+        manifest = Manifest(path)
+        self.addCleanup(manifest.close)
+        self.assertEqual(manifest.get('a'), ManifestEntry('a', '/a', 1))
+        manifest.record(ManifestEntry('b', '/b', 2, sha256='00ff'))
+        self.assertEqual(manifest.get('b').sha256, '00ff')
+
+
+class ContentStoreTests(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manifest = Manifest(os.path.join(self.storage_path, 'state', 'm.sqlite3'))
+        self.addCleanup(self.manifest.close)
+        self.store = ContentStore(os.path.join(self.storage_path, 'store'))
+        self.digest = hashlib.sha256(self.image).hexdigest()
+
+    def make_downloader(self, sync=False):
+        return ImageDownloader(self.base_resolution, manifest=self.manifest, sync=sync,
+                               retry=RetryPolicy(1), store=self.store)
+
+    def test_duplicates_are_hardlinked(self):
+        '''Ensure if the same content in two directories is stored once'''
+        other_path = os.path.join(self.storage_path, 'other')
+        os.makedirs(other_path)
+        image_downloader = self.make_downloader()
+        self.assertTrue(self.download(self.make_app(), image_downloader))
+        self.assertTrue(self.download(self.make_app(), image_downloader, other_path))
+        self.assertEqual(image_downloader.stats['deduplicated'], 1)
+
+        blob_path = self.store.get_blob_path(self.digest)
+        other_image_path = os.path.join(other_path, 'image.png')
+        self.assert_downloaded()
+        self.assertEqual(os.stat(blob_path).st_ino, os.stat(self.image_path).st_ino)
+        self.assertEqual(os.stat(blob_path).st_ino, os.stat(other_image_path).st_ino)
+        self.assertFalse(os.path.exists(other_image_path + '.part'))
+
+    def test_missing_image_is_restored(self):
+        '''Ensure if image deleted from month directory is restored from store'''
+        self.download(self.make_app(), self.make_downloader())
+        os.remove(self.image_path)
+        image_downloader = self.make_downloader(sync=True)
+        self.assertTrue(self.download(self.make_app(), image_downloader))
+        self.assertEqual(image_downloader.stats, {'unchanged': 1})
+        self.assert_downloaded()
+
+    def test_link_fallback(self):
+        '''Ensure if file is copied where hardlinks and reflinks fail'''
+        source = os.path.join(self.storage_path, 'source')
+        target = os.path.join(self.storage_path, 'target')
+        for path in (source, target):
+            with open(path, 'wb') as f:
+                f.write(path.encode())
+        with mock.patch('downloader.os.link', side_effect=OSError), \
+                mock.patch('downloader.reflink_file', side_effect=OSError):
+            link_file(source, target)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), source.encode())
+        self.assertNotEqual(os.stat(source).st_ino, os.stat(target).st_ino)
+
+
+class RetryTests(DownloadTestCase):
+    def make_flaky_app(self, *responses):
+        '''Create application answering with given responses before serving image'''
+        responses = list(responses)
+
+        async def image(request):
+            self.requests.append(request.headers.get('Range'))
+            if responses:
+                return responses.pop(0)
+            return web.Response(body=self.image)
+
+        app = web.Application()
+        app.router.add_get('/image.png', image)
+        return app
+
+    def test_transient_errors_are_retried(self):
+        '''Ensure if image is downloaded after transient errors'''
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(3, base_delay=0))
+        app = self.make_flaky_app(web.Response(status=502), web.Response(status=500))
+        self.assertTrue(self.download(app, image_downloader))
+        self.assert_downloaded()
+        self.assertEqual(image_downloader.stats['retries'], 2)
+
+    def test_retries_are_limited(self):
+        '''Ensure if failure reason is reported when attempts are exhausted'''
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(2, base_delay=0))
+        app = self.make_flaky_app(*[web.Response(status=503) for _ in range(3)])
+        self.assertFalse(self.download(app, image_downloader))
+        self.assertEqual(len(self.requests), 2)
+        (link, reason), = image_downloader.failures
+        self.assertTrue(link.endswith('/image.png'))
+        self.assertEqual(reason, 'Error 503')
+
+    def test_client_errors_are_not_retried(self):
+        '''Ensure if 404 response is not retried'''
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(3, base_delay=0))
+        self.assertFalse(self.download(
+            self.make_flaky_app(web.Response(status=404)), image_downloader))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(image_downloader.failures[0][1], 'Error 404')
+
+    def test_retry_after(self):
+        '''Ensure if delay from Retry-After header is honoured'''
+        policy = RetryPolicy(3, base_delay=0, max_delay=10)
+        err = aiohttp.ClientResponseError(
+            None, (), status=429, headers={'Retry-After': '2'})
+        self.assertEqual(policy.get_delay(1, err), 2)
+        self.assertIsNone(policy.get_delay(3, err))
+        err.headers = {'Retry-After': '120'}
+        self.assertIsNone(policy.get_delay(1, err))
+        err.headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+        self.assertEqual(policy.get_delay(1, err), 0)
+
+    def test_circuit_breaker(self):
+        '''Ensure if circuit opens after failures and closes after trial'''
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        for _ in range(2):
+            breaker.check()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, breaker.check)
+
+        time.sleep(0.06)
+        breaker.check()
+        self.assertRaises(CircuitOpenError, breaker.check)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+        time.sleep(0.06)
+        breaker.check()
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_cancelled_trial(self):
+        '''Ensure if cancelled trial request lets the next request be trial
+        one instead of keeping the circuit half-open'''
+        image_downloader = ImageDownloader(self.base_resolution)
+        breaker = image_downloader.breakers['host']
+        breaker.opened_at = time.monotonic() - breaker.reset_timeout
+
+        async def hang():
+            await asyncio.sleep(10)
+
+        async def succeed():
+            return 'ok'
+
+        async def run():
+            task = asyncio.create_task(image_downloader.with_retry('http://host/a', hang))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(breaker.state, 'half-open')
+            return await image_downloader.with_retry('http://host/b', succeed)
+
+        self.assertEqual(asyncio.run(run()), 'ok')
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_open_circuit_fails_fast(self):
+        '''Ensure if no requests are made to host with open circuit'''
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(5, base_delay=0))
+        image_downloader.breakers = collections.defaultdict(
+            lambda: CircuitBreaker(failure_threshold=2))
+        app = self.make_flaky_app(*[web.Response(status=500) for _ in range(5)])
+        self.assertFalse(self.download(app, image_downloader))
+        self.assertEqual(len(self.requests), 2)
+        self.assertIn('suspended', image_downloader.failures[0][1])
+
+
+class SchedulerTests(unittest.TestCase):
+    def run_targets(self, image_downloader, targets):
+        '''Run scheduler with mocked download, return number of downloaded
+        images, links are collected in order of download'''
+        async def download_image(session, storage_path, link):
+            self.downloaded.append(link)
+            await asyncio.sleep(0)
+            return not link.endswith('fail.png')
+
+        async def run():
+            return await image_downloader.download_targets(None, targets)
+
+        self.downloaded = []
+        with mock.patch.object(image_downloader, 'download_image', download_image):
+            return asyncio.run(run())
+
+    def test_links_are_consumed_lazily(self):
+        '''Ensure if scheduler holds bounded number of links at once'''
+        image_downloader = ImageDownloader(
+            '640x480', concurrency=FixedConcurrency(2), queue_size=3)
+        produced = []
+
+        def targets():
+            for number in range(1000):
+                produced.append(number)
+                # Links waiting in queue, being downloaded and being produced
+                self.assertLessEqual(len(produced) - len(self.downloaded), 3 + 2 + 1)
+                yield '/', 'image-{}.png'.format(number)
+
+        self.assertEqual(self.run_targets(image_downloader, targets()), 1000)
+        self.assertEqual(self.downloaded, ['image-{}.png'.format(n) for n in range(1000)])
+
+    def test_order(self):
+        '''Ensure if images can be downloaded smallest or largest first'''
+        links = ['a-1920x1080.png', 'b-800x480.png', 'c-fail.png', 'd-3840x2160.png']
+        test_cases = [
+            ('page', links, 3),
+            ('smallest', ['c-fail.png', 'b-800x480.png', 'a-1920x1080.png',
+                          'd-3840x2160.png'], 3),
+            ('largest', ['d-3840x2160.png', 'a-1920x1080.png', 'b-800x480.png',
+                         'c-fail.png'], 3),
+        ]
+        for order, exp_output, exp_count in test_cases:
+            with self.subTest(x=order):
+                image_downloader = ImageDownloader(
+                    '640x480', concurrency=FixedConcurrency(1), order=order)
+                count = self.run_targets(
+                    image_downloader, [('/', link) for link in links])
+                self.assertEqual(self.downloaded, exp_output)
+                self.assertEqual(count, exp_count)
+
+        self.assertRaises(ValueError, ImageDownloader, '640x480', order='random')
+
+
+class StreamTests(DownloadTestCase):
+    def test_results(self):
+        '''Ensure if result of each image is yielded and given session and
+        connector are left open'''
+        image_downloader = ImageDownloader(self.base_resolution, retry=RetryPolicy(1))
+        directories = [os.path.join(self.storage_path, name) for name in ('a', 'b')]
+        for directory in directories:
+            os.mkdir(directory)
+
+        async def run():
+            async with TestServer(self.make_app(), port=self.port) as server:
+                url = str(server.make_url('/image.png'))
+                targets = [(directory, url) for directory in directories]
+                targets.append((self.storage_path, str(server.make_url('/missing.png'))))
+                connector = aiohttp.TCPConnector()
+                async with image_downloader.create_session(connector) as session:
+                    results = [result async for result in
+                               image_downloader.iter_downloads(targets, session)]
+                    self.assertFalse(session.closed)
+                self.assertFalse(connector.closed)
+                await connector.close()
+                return results
+
+        results = sorted(asyncio.run(run()), key=lambda result: result.path)
+        self.assertEqual([result.status for result in results],
+                         ['downloaded', 'downloaded', 'failed'])
+        for directory, result in zip(directories, results):
+            self.assertTrue(result)
+            self.assertEqual(result.path, os.path.join(directory, 'image.png'))
+            self.assertEqual(result.bytes, len(self.image))
+            self.assertIsNone(result.error)
+        self.assertFalse(results[2])
+        self.assertIn('404', results[2].error)
+
+    def test_backpressure_and_cancellation(self):
+        '''Ensure if slow consumer stops workers and closing the stream
+        cancels downloads in progress'''
+        image_downloader = ImageDownloader(
+            '640x480', concurrency=FixedConcurrency(2), queue_size=2)
+        started, cancelled = [], []
+
+        async def download_image(session, storage_path, link):
+            started.append(link)
+            try:
+                await asyncio.sleep(0.01)
+            except asyncio.CancelledError:
+                cancelled.append(link)
+                raise
+            return DownloadResult(link, link, 'downloaded')
+
+        async def run():
+            targets = [('/', 'image-{}.png'.format(number)) for number in range(100)]
+            stream = image_downloader.iter_downloads(targets, session=object())
+            self.assertEqual((await stream.__anext__()).url, 'image-0.png')
+            await asyncio.sleep(0.2)
+            # Results waiting for consumer, being put and being downloaded
+            self.assertLessEqual(len(started), 1 + 2 + 2 + 2)
+            await stream.__anext__()
+            await asyncio.sleep(0.005)
+            await stream.aclose()
+            count = len(started)
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(started), count)
+
+        with mock.patch.object(image_downloader, 'download_image', download_image):
+            asyncio.run(run())
+        self.assertTrue(cancelled)
+
+
+class ConcurrencyPolicyTests(unittest.TestCase):
+    def test_fixed_limit(self):
+        '''Ensure if fixed policy never exceeds its limit'''
+        policy = FixedConcurrency(3)
+
+        async def request():
+            started = await policy.acquire()
+            self.assertLessEqual(policy.in_flight, 3)
+            await asyncio.sleep(0.01)
+            await policy.release(started, 100, congested=True)
+
+        async def run():
+            await asyncio.gather(*[request() for _ in range(10)])
+
+        asyncio.run(run())
+        self.assertEqual((policy.limit, policy.peak, policy.in_flight), (3, 3, 0))
+
+    def test_adaptive_increase(self):
+        '''Ensure if adaptive policy raises limit while throughput improves'''
+        policy = AdaptiveConcurrency(4, maximum=6)
+
+        async def run():
+            for _ in range(40):
+                started = await policy.acquire()
+                await policy.release(started, 10 ** 6)
+
+        asyncio.run(run())
+        self.assertEqual(policy.limit, 6)
+
+    def test_adaptive_decrease(self):
+        '''Ensure if adaptive policy halves limit once per burst of congestion'''
+        policy = AdaptiveConcurrency(8, minimum=3)
+
+        async def run():
+            started = [await policy.acquire() for _ in range(3)]
+            await policy.release(started[0], congested=True)
+            await policy.release(started[1], congested=True)
+            self.assertEqual(policy.limit, 4)
+            await policy.release(started[2])
+            started = await policy.acquire()
+            await policy.release(started, congested=True)
+            self.assertEqual(policy.limit, 3)
+
+        asyncio.run(run())
+
+    def test_invalid_limits(self):
+        '''Ensure if policy can't be created with invalid limits'''
+        self.assertRaises(ValueError, FixedConcurrency, 0)
+        self.assertRaises(ValueError, AdaptiveConcurrency, 5, 6)
+        self.assertRaises(ValueError, AdaptiveConcurrency, 5, 1, 4)
+
+    def test_server_errors_reported(self):
+        '''Ensure if 503 response is reported to policy as congestion'''
+        async def unavailable(request):
+            return web.Response(status=503)
+
+        app = web.Application()
+        app.router.add_get('/image.png', unavailable)
+        policy = AdaptiveConcurrency(8)
+        image_downloader = ImageDownloader(
+            '640x480', concurrency=policy, retry=RetryPolicy(1))
+
+        async def run():
+            with tempfile.TemporaryDirectory() as storage_path:
+                async with TestServer(app) as server, \
+                        image_downloader.create_session() as session:
+                    return await image_downloader.download_image(
+                        session, storage_path, str(server.make_url('/image.png')))
+
+        self.assertFalse(asyncio.run(run()))
+        self.assertEqual(policy.limit, 4)
+
+
+class UnseekableStream:
+    '''Write-only stream, like pipe to standard output'''
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+class ArchiveTests(DownloadTestCase):
+    def make_downloader(self, writer, attempts=1, buffer_size=4 * 1024):
+        archive = ArchiveStream(writer, self.storage_path, buffer_size)
+        return ImageDownloader(self.base_resolution, archive=archive, chunk_size=1024,
+                               retry=RetryPolicy(attempts, base_delay=0))
+
+    def archive(self, app, image_downloader, names):
+        '''Download images with given names into archive of downloader'''
+        month_path = image_downloader.create_directory(self.storage_path, 'May', 2019)
+
+        async def run():
+            async with TestServer(app, port=self.port) as server, \
+                    aiohttp.ClientSession() as session:
+                await image_downloader.download_targets(session, [
+                    (month_path, str(server.make_url('/' + name))) for name in names])
+            await image_downloader.archive.close()
+
+        asyncio.run(run())
+
+    def make_images_app(self):
+        '''Create application serving distinct images under any name'''
+        async def image(request):
+            name = request.match_info['name'].encode()
+            return web.Response(body=self.image + name)
+
+        app = web.Application()
+        app.router.add_get('/{name}', image)
+        return app
+
+    def test_tar_archive(self):
+        '''Ensure if concurrent downloads are written to tar archive whole
+        and nothing is written to disk'''
+        stream = io.BytesIO()
+        image_downloader = self.make_downloader(TarArchiveWriter(stream))
+        names = ['image-{}.png'.format(number) for number in range(10)]
+        self.archive(self.make_images_app(), image_downloader, names)
+
+        self.assertEqual(image_downloader.stats, {'downloaded': 10})
+        self.assertEqual(os.listdir(self.storage_path), [])
+        self.assertEqual(len(stream.getvalue()) % tarfile.RECORDSIZE, 0)
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            members = tar.getmembers()
+            self.assertCountEqual(
+                [member.name for member in members],
+                ['Smashing_wallpaper_May_2019/' + name for name in names])
+            for member in members:
+                self.assertEqual(tar.extractfile(member).read(),
+                                 self.image + os.path.basename(member.name).encode())
+
+    def test_zip_archive_to_pipe(self):
+        '''Ensure if zip archive is written to stream which can not seek'''
+        stream = UnseekableStream()
+        image_downloader = self.make_downloader(ZipArchiveWriter(stream))
+        self.archive(self.make_images_app(), image_downloader, ['a.png', 'b.png'])
+        with zipfile.ZipFile(io.BytesIO(stream.buffer.getvalue())) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('Smashing_wallpaper_May_2019/b.png'),
+                             self.image + b'b.png')
+
+    def test_interrupted_download_is_resumed(self):
+        '''Ensure if entry is completed with range request after interruption'''
+        stream = io.BytesIO()
+        image_downloader = self.make_downloader(TarArchiveWriter(stream), attempts=2)
+        self.archive(self.make_app(truncate_at=3000), image_downloader, ['image.png'])
+        self.assertEqual(image_downloader.stats, {'downloaded': 1, 'retries': 1})
+        self.assertEqual(self.requests, [None, 'bytes=3000-'])
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            self.assertEqual(tar.extractfile(
+                'Smashing_wallpaper_May_2019/image.png').read(), self.image)
+
+    def test_incomplete_entry(self):
+        '''Ensure if archive stays readable when download fails midway'''
+        stream = io.BytesIO()
+        image_downloader = self.make_downloader(TarArchiveWriter(stream))
+        self.archive(self.make_app(truncate_at=3000), image_downloader, ['image.png'])
+        self.assertEqual(image_downloader.stats, {'failed': 1})
+        self.assertIn('archive entry is incomplete', image_downloader.failures[0][1])
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            content = tar.extractfile('Smashing_wallpaper_May_2019/image.png').read()
+        self.assertEqual(content, self.image[:3000] + bytes(len(self.image) - 3000))
+
+    def test_signature_split_between_chunks(self):
+        '''Ensure if image is recognized when its first chunk is shorter
+        than signature'''
+        async def image(request):
+            response = web.StreamResponse(headers={
+                'Content-Length': str(len(self.image))})
+            await response.prepare(request)
+            await response.write(self.image[:4])
+            await asyncio.sleep(0.1)
+            await response.write(self.image[4:])
+            return response
+
+        app = web.Application()
+        app.router.add_get('/image.png', image)
+        stream = io.BytesIO()
+        image_downloader = self.make_downloader(TarArchiveWriter(stream))
+        self.archive(app, image_downloader, ['image.png'])
+        self.assertEqual(image_downloader.stats, {'downloaded': 1})
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            self.assertEqual(tar.extractfile(
+                'Smashing_wallpaper_May_2019/image.png').read(), self.image)
+
+    def test_error_page_is_not_archived(self):
+        '''Ensure if content which is not an image gets no entry'''
+        async def page(request):
+            return web.Response(body=b'<html>Not found</html>')
+
+        app = web.Application()
+        app.router.add_get('/image.png', page)
+        stream = io.BytesIO()
+        image_downloader = self.make_downloader(TarArchiveWriter(stream))
+        self.archive(app, image_downloader, ['image.png'])
+        self.assertEqual(image_downloader.stats, {'failed': 1})
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            self.assertEqual(tar.getmembers(), [])
+
+
+class RateLimitTests(DownloadTestCase):
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('500'), 500)
+        self.assertEqual(parse_rate('1.5M'), 1.5 * 2 ** 20)
+        self.assertEqual(parse_rate('200k'), 200 * 1024)
+        self.assertIsNone(parse_rate('0'))
+        self.assertRaises(ValueError, parse_rate, '5 MB/s')
+
+    def test_token_bucket(self):
+        '''Ensure if burst is served at once and the rest at given rate'''
+        with mock.patch('downloader.time.monotonic', return_value=100.0) as monotonic:
+            bucket = TokenBucket(100, burst=50)
+            self.assertEqual(bucket.reserve(50), 0)
+            self.assertEqual(bucket.reserve(100), 1)
+            # The debt is paid before the next caller is served
+            self.assertEqual(bucket.reserve(10), 1.1)
+            monotonic.return_value = 102.0
+            self.assertAlmostEqual(bucket.reserve(10), 0)
+            bucket.configure(None)
+            self.assertEqual(bucket.reserve(10 ** 9), 0)
+
+    def test_host_limits(self):
+        '''Ensure if every host has its own bucket under common one'''
+        limiter = RateLimiter(request_rate=100, host_request_rate=1, burst=1)
+        delays = []
+        for url in ('http://a/1', 'http://b/1', 'http://a/2'):
+            delays.append(max(bucket.reserve(1) for bucket in (
+                limiter.requests, limiter._get_host_bucket(
+                    limiter.host_requests, url, limiter.host_request_rate))))
+        self.assertEqual(delays[:2], [0, 0])
+        self.assertAlmostEqual(delays[2], 1, places=2)
+
+    def test_download_is_limited(self):
+        '''Ensure if download takes as long as byte rate requires'''
+        rate = 4 * len(self.image)
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(1), chunk_size=8192,
+            limiter=RateLimiter(rate, burst=0))
+        started = time.monotonic()
+        self.assertTrue(self.download(self.make_app(), image_downloader))
+        self.assertGreater(time.monotonic() - started, 0.2)
+        self.assert_downloaded()
+
+    def test_limits_file(self):
+        '''Ensure if limits are changed by control file and SIGHUP'''
+        path = os.path.join(self.storage_path, 'limits')
+        with open(path, 'w') as f:
+            f.write('limit-rate = 2M  # daytime\nhost-limit-requests = 5\n')
+        limiter = RateLimiter(1024, request_rate=10, burst=2)
+        limiter.watch(path)
+        self.assertEqual((limiter.byte_rate, limiter.request_rate, limiter.host_request_rate),
+                         (2 * 2 ** 20, 10, 5))
+        self.assertEqual(limiter.bytes.burst, 4 * 2 ** 20)
+
+        with open(path, 'w') as f:
+            f.write('limit-rate = 0\nspeed = 1\n')
+        with mock.patch('builtins.print') as mock_print:
+            limiter.reload()
+        self.assertIn('Unknown limit', str(mock_print.call_args))
+        self.assertEqual(limiter.byte_rate, 2 * 2 ** 20)
+
+        with open(path, 'w') as f:
+            f.write('limit-rate = 0\n')
+
+        async def run():
+            await limiter.request('http://a/')
+            os.kill(os.getpid(), signal.SIGHUP)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        self.assertIsNone(limiter.byte_rate)
+
+
+class MetricsTests(DownloadTestCase):
+    def test_stage_histogram(self):
+        '''Ensure if calls of stage are summed and put into buckets'''
+        metrics = Metrics(buckets=(0.1, 1))
+        for seconds in (0.05, 0.5, 0.7, 5):
+            metrics.observe('download', seconds)
+        self.assertEqual(metrics.histograms['download'], [1, 2, 1])
+        self.assertEqual(metrics.calls['download'], 4)
+        self.assertAlmostEqual(metrics.seconds['download'], 6.25)
+        self.assertEqual(metrics.get_quantile('download', 0.5), 1)
+        self.assertIsNone(metrics.get_quantile('download', 0.95))
+
+    def test_stage_errors(self):
+        '''Ensure if reason of exception raised in stage is recorded'''
+        metrics = Metrics()
+        with self.assertRaises(asyncio.TimeoutError):
+            with metrics.stage('fetch_page'):
+                raise asyncio.TimeoutError()
+        self.assertEqual(metrics.errors, {('fetch_page', 'Connection timed out'): 1})
+        self.assertEqual(metrics.calls['fetch_page'], 1)
+
+    def test_download_report(self):
+        '''Ensure if report covers downloaded and failed images, and keeps
+        retries apart from outcomes of images'''
+        image_downloader = ImageDownloader(
+            self.base_resolution, retry=RetryPolicy(2, base_delay=0))
+        self.download(self.make_app(), image_downloader)
+        os.remove(self.image_path)
+        self.download(self.make_app(support_range=False, truncate_at=100), image_downloader)
+
+        report = image_downloader.metrics.get_report(image_downloader)
+        self.assertEqual(report['images'], {'downloaded': 1, 'unchanged': 0, 'failed': 1})
+        self.assertEqual((report['deduplicated'], report['retries'], report['cached_pages']),
+                         (0, 1, 0))
+        text = format_prometheus(report)
+        self.assertIn('smashing_images{outcome="failed"} 1\n', text)
+        self.assertIn('smashing_retries 1\n', text)
+        self.assertNotIn('outcome="retries"', text)
+        self.assertEqual(report['bytes'], len(self.image))
+        self.assertEqual(report['stages']['download']['calls'], 2)
+        self.assertEqual(sum(report['stages']['download']['histogram'].values()), 2)
+        self.assertEqual(report['errors'], [{
+            'stage': 'download', 'reason': 'Connection closed before download completed',
+            'count': 1}])
+        self.assertEqual(report['concurrency'], {'limit': 5, 'peak': 1})
+
+    def test_prometheus_format(self):
+        '''Ensure if histogram buckets are cumulative and labels escaped'''
+        metrics = Metrics(buckets=(1,))
+        metrics.observe('download', 0.5)
+        metrics.observe('download', 2)
+        metrics.errors['download', 'Bad "quote"'] += 1
+        text = format_prometheus(metrics.get_report(ImageDownloader('640x480')))
+        self.assertIn('smashing_stage_duration_seconds_bucket'
+                      '{stage="download",le="1"} 1\n', text)
+        self.assertIn('smashing_stage_duration_seconds_bucket'
+                      '{stage="download",le="+Inf"} 2\n', text)
+        self.assertIn('smashing_stage_duration_seconds_count{stage="download"} 2\n', text)
+        self.assertIn('smashing_errors{stage="download",reason="Bad \\"quote\\""} 1\n',
+                      text)
+        self.assertIn('# TYPE smashing_stage_duration_seconds histogram\n', text)
+
+
+class PageCacheTests(unittest.TestCase):
+    page = make_page(3)
+    etag = '"page"'
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_path = os.path.join(temp_dir.name, 'pages.sqlite3')
+        self.requests = []
+        self.port = unused_port()
+
+    def make_cache(self, **kwargs):
+        page_cache = PageCache(self.cache_path, **kwargs)
+        self.addCleanup(page_cache.close)
+        return page_cache
+
+    def get_index(self, image_downloader):
+        '''Return index of test page served by local server'''
+        async def page(request):
+            self.requests.append(request.headers.get('If-None-Match'))
+            if request.headers.get('If-None-Match') == self.etag:
+                return web.Response(status=304)
+            return web.Response(body=self.page, headers={'ETag': self.etag})
+
+        app = web.Application()
+        app.router.add_get('/page', page)
+
+        async def run():
+            async with TestServer(app, port=self.port) as server, \
+                    aiohttp.ClientSession() as session:
+                self.url = str(server.make_url('/page'))
+                return await image_downloader.get_page_index(session, self.url)
+
+        return asyncio.run(run())
+
+    def test_fresh_page_is_not_requested(self):
+        '''Ensure if fresh cached page is used without request'''
+        page_cache = self.make_cache()
+        index = self.get_index(ImageDownloader('640x480', page_cache=page_cache))
+        image_downloader = ImageDownloader('640x480', page_cache=page_cache)
+        self.assertEqual(self.get_index(image_downloader), index)
+        self.assertEqual(self.requests, [None])
+        self.assertEqual(image_downloader.stats['cached_pages'], 1)
+        self.assertEqual(len(index['640x480']), 6)
+
+    def test_other_resolutions_are_cached(self):
+        '''Ensure if cached page serves resolutions not requested before'''
+        page_cache = self.make_cache()
+        self.get_index(ImageDownloader('640x480', page_cache=page_cache))
+        index = self.get_index(ImageDownloader(('800x600', '1920x1080'),
+                                               page_cache=page_cache))
+        expected = ImageDownloader(('800x600', '1920x1080')).get_link_index(self.page)
+        self.assertEqual(index, expected)
+        self.assertEqual(self.requests, [None])
+
+    def test_stale_page_is_revalidated(self):
+        '''Ensure if stale page is revalidated with conditional request'''
+        page_cache = self.make_cache(ttl=0)
+        index = self.get_index(ImageDownloader('640x480', page_cache=page_cache))
+        image_downloader = ImageDownloader('640x480', page_cache=page_cache)
+        self.assertEqual(self.get_index(image_downloader), index)
+        self.assertEqual(self.requests, [None, self.etag])
+        self.assertEqual(image_downloader.stats['cached_pages'], 1)
+
+    def test_changed_page_is_parsed(self):
+        '''Ensure if page changed on server replaces cached one'''
+        page_cache = self.make_cache(ttl=0)
+        self.get_index(ImageDownloader('640x480', page_cache=page_cache))
+        self.page, self.etag = make_page(1), '"other"'
+        image_downloader = ImageDownloader('640x480', page_cache=page_cache)
+        self.assertEqual(len(self.get_index(image_downloader)['640x480']), 2)
+        self.assertEqual(image_downloader.stats['cached_pages'], 0)
+        self.assertEqual(page_cache.get(self.url).etag, '"other"')
+
+    def test_eviction(self):
+        '''Ensure if least recently used pages are evicted over size limit'''
+        page_cache = self.make_cache(max_size=2 * len(self.page))
+        response = collections.namedtuple('Response', 'content etag last_modified')(
+            self.page, None, None)
+        for url in ('a', 'b', 'c'):
+            page_cache.put(url, response, {})
+            time.sleep(0.01)
+        self.assertIsNone(page_cache.get('a'))
+        self.assertIsNotNone(page_cache.get('b'))
+        self.assertIsNotNone(page_cache.get('c'))
+
+
+def claim_all(queue_path, worker):
+    '''Claim units from work queue until none is left, run in worker process'''
+    work_queue = WorkQueue(queue_path)
+    claimed = []
+    while True:
+        unit = work_queue.claim(worker)
+        if unit is None:
+            break
+        claimed.append(unit)
+        time.sleep(0.001)
+    work_queue.close()
+    return claimed
+
+
+def crashing_worker(queue_path, lease, url, basic_directory, downloader_options,
+                    state_options):
+    '''Stand-in of run_worker: the first worker crashes holding a unit,
+    the others complete units until none is left'''
+    worker = get_worker_name(os.getpid())
+    work_queue = WorkQueue(queue_path, lease)
+    try:
+        os.close(os.open(queue_path + '.crashed', os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        while True:
+            unit = work_queue.claim(worker)
+            if unit is None:
+                break
+            work_queue.complete(worker, MonthReport(Month(str(unit[1])), unit[0], 1, 1))
+        work_queue.close()
+    else:
+        work_queue.claim(worker)
+        os._exit(1)
+
+
+class WorkQueueTests(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.queue_path = os.path.join(temp_dir.name, 'queue.sqlite3')
+
+    def make_queue(self, **kwargs):
+        work_queue = WorkQueue(self.queue_path, **kwargs)
+        self.addCleanup(work_queue.close)
+        return work_queue
+
+    def report(self, year, month, error=None):
+        return MonthReport(Month(str(month)), year, 2, 0 if error else 2, error)
+
+    def test_units_are_claimed_once(self):
+        '''Ensure if every unit is claimed by one worker, in order'''
+        work_queue = self.make_queue()
+        work_queue.add([(2019, 5), (2019, 4), (2018, 12)])
+        work_queue.add([(2019, 5)])
+        self.assertEqual(work_queue.claim('a'), (2018, 12))
+        self.assertEqual(work_queue.claim('b'), (2019, 4))
+        self.assertEqual(work_queue.claim('a'), (2019, 5))
+        self.assertIsNone(work_queue.claim('b'))
+
+    def test_expired_lease_is_reclaimed(self):
+        '''Ensure if unit of lost worker is claimed again, and the lost
+        worker can not complete it'''
+        work_queue = self.make_queue(lease=0.05, max_attempts=2)
+        work_queue.add([(2019, 5)])
+        self.assertEqual(work_queue.claim('lost'), (2019, 5))
+        self.assertIsNone(work_queue.claim('other'))
+        time.sleep(0.1)
+        self.assertEqual(work_queue.claim('other'), (2019, 5))
+        self.assertFalse(work_queue.complete('lost', self.report(2019, 5)))
+        self.assertTrue(work_queue.complete('other', self.report(2019, 5)))
+        self.assertEqual(work_queue.get_counts(), {'done': (1, 2, 2)})
+
+    def test_heartbeat_keeps_lease(self):
+        '''Ensure if unit of live worker is not claimed again'''
+        work_queue = self.make_queue(lease=0.1)
+        work_queue.add([(2019, 5)])
+        work_queue.claim('live')
+        for _ in range(3):
+            time.sleep(0.05)
+            work_queue.heartbeat('live')
+        self.assertIsNone(work_queue.claim('other'))
+
+    def test_failed_units(self):
+        '''Ensure if unit lost too many times fails, and failed units are
+        queued again when added'''
+        work_queue = self.make_queue(lease=0, max_attempts=1)
+        work_queue.add([(2019, 5), (2019, 6)])
+        work_queue.claim('lost')
+        self.assertEqual(work_queue.claim('other'), (2019, 6))
+        work_queue.complete('other', self.report(2019, 6, 'Error 404'))
+        self.assertEqual(work_queue.get_failures(), [
+            (2019, 5, 'Worker was lost 1 times'), (2019, 6, 'Error 404')])
+        work_queue.add([(2019, 5), (2019, 6)])
+        self.assertEqual(work_queue.get_counts(), {'pending': (2, 0, 0)})
+
+    def test_release(self):
+        '''Ensure if units of dead worker are queued again at once, and fail
+        when lost too many times'''
+        work_queue = self.make_queue(max_attempts=2)
+        work_queue.add([(2019, 5), (2019, 6)])
+        work_queue.claim('dead')
+        self.assertEqual(work_queue.claim('live'), (2019, 6))
+        self.assertEqual(work_queue.release('dead'), 1)
+        self.assertEqual(work_queue.claim('dead'), (2019, 5))
+        self.assertEqual(work_queue.release('dead'), 0)
+        self.assertEqual(work_queue.get_failures(), [(2019, 5, 'Worker was lost 2 times')])
+        self.assertEqual(work_queue.get_counts()['claimed'][0], 1)
+
+    def test_crashed_worker_is_replaced(self):
+        '''Ensure if month held by crashed worker is downloaded by another
+        one instead of being left claimed'''
+        months = [(Month(str(month)), 2019) for month in range(1, 7)]
+        with mock.patch('downloader.run_worker', crashing_worker), \
+                mock.patch('builtins.print'):
+            finished = download_sharded(self.queue_path, 300, 2, months, 'url', 'dir',
+                                        {}, StateOptions())
+        self.assertTrue(finished)
+        self.assertEqual(self.make_queue().get_counts(), {'done': (6, 6, 6)})
+
+    def test_processes_claim_distinct_units(self):
+        '''Ensure if workers in several processes never claim the same unit'''
+        units = [(year, month) for year in range(2011, 2021) for month in range(1, 13)]
+        self.make_queue().add(units)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(4) as pool:
+            results = pool.starmap(claim_all, [(self.queue_path, str(n)) for n in range(4)])
+        claimed = [unit for result in results for unit in result]
+        self.assertCountEqual(claimed, units)
+
+    def test_download_units(self):
+        '''Ensure if worker downloads claimed months and records outcomes'''
+        work_queue = self.make_queue()
+        work_queue.add([(2019, 4), (2019, 5)])
+        image_downloader = ImageDownloader('640x480')
+
+        async def download_months(url, basic_directory, months):
+            for month, year in months:
+                yield self.report(year, month.number, 'Error 404' if month.number == 5 else None)
+
+        image_downloader.download_months = download_months
+        with mock.patch('builtins.print'):
+            asyncio.run(download_units(image_downloader, work_queue, 'w', 'url', 'dir'))
+        self.assertEqual(work_queue.get_counts(), {'done': (1, 2, 2), 'failed': (1, 2, 0)})
+
+
+class CatalogueTests(unittest.TestCase):
+    runner = CliRunner()
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.catalogue_path = os.path.join(temp_dir.name, 'catalogue.sqlite3')
+
+    def build_catalogue(self):
+        '''Index synthetic pages of two months'''
+        image_downloader = ImageDownloader(None)
+        catalogue = Catalogue(self.catalogue_path)
+        self.addCleanup(catalogue.close)
+        for month, year, designs in (('may', 2018, 2), ('june', 2019, 1)):
+            page = make_page(designs, month, year)
+
+            async def get_page_index(session, url):
+                return image_downloader.get_link_index(page)
+
+            image_downloader.get_page_index = get_page_index
+            entries = asyncio.run(image_downloader.index_month(
+                None, 'url', Month(month), year))
+            catalogue.replace_month(year, Month(month).number, entries)
+        return catalogue
+
+    def test_parse_wallpaper_link(self):
+        '''Ensure if design and variant are taken from wallpaper link'''
+        self.assertEqual(parse_wallpaper_link(
+            'https://www.smashingmagazine.com/files/wallpapers/may-19/be-happy/'
+            'nocal/may-19-be-happy-nocal-1920x1080.png'), ('be-happy', 'nocal'))
+        self.assertEqual(parse_wallpaper_link(
+            'https://example.com/files/may-13-be-happy-1920x1080.jpg'),
+            ('may-13-be-happy', None))
+
+    def test_query(self):
+        '''Ensure if entries match every given condition'''
+        catalogue = self.build_catalogue()
+        self.assertEqual(catalogue.count(), (2 + 1) * 2 * 22)
+        entries = catalogue.query(['3840x2160'], [2018], variant='nocal')
+        self.assertEqual([(entry.year, entry.month, entry.design, entry.variant)
+                          for entry in entries],
+                         [(2018, 5, 'design-0', 'nocal'), (2018, 5, 'design-1', 'nocal')])
+        self.assertTrue(entries[0].url.endswith('may-18-design-0-nocal-3840x2160.png'))
+        self.assertEqual(len(catalogue.query(months=[6], design='n-0')), 2 * 22)
+        self.assertEqual(len(catalogue.query(design='%')), 0)
+        self.assertEqual({entry.resolution for entry in catalogue.query(
+            min_width=2000, min_height=1400)}, {'2560x1440', '3840x2160'})
+
+    def test_month_is_replaced(self):
+        '''Ensure if indexing month again replaces its entries'''
+        catalogue = self.build_catalogue()
+        catalogue.replace_month(2018, 5, [CatalogueEntry(
+            2018, 5, 'other', 'cal', '640x480', 'https://example.com/other.png', 10)])
+        self.assertEqual(catalogue.query(years=[2018]), [CatalogueEntry(
+            2018, 5, 'other', 'cal', '640x480', 'https://example.com/other.png', 10)])
+
+    def test_query_command(self):
+        '''Ensure if query command prints matching urls'''
+        self.build_catalogue()
+        result = self.runner.invoke(cli, [
+            'query', '--catalogue', self.catalogue_path, '-r', '640x480', '-m', 'June',
+            '--variant', 'cal'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output.splitlines(), [
+            'https://files.smashing.media/wallpapers/june-19/design-0/cal/'
+            'june-19-design-0-cal-640x480.png'])
+        result = self.runner.invoke(cli, [
+            'query', '--catalogue', self.catalogue_path, '-r', '64x48'])
+        self.assertIn('Resolution value is not valid', result.output)
+
+    def test_download_is_default_command(self):
+        '''Ensure if options without command name go to download command'''
+        result = self.runner.invoke(cli, ['-m', '5'])
+        self.assertIn("Missing option '-r' / '--resolution'", result.output)
+        self.assertEqual(result.exit_code, 2)
+
+
+class StartupTests(unittest.TestCase):
+    '''Help and validation of arguments must not pay for heavy imports'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    heavy_modules = ('asyncio', 'aiohttp', 'bs4', 'lxml', 'sqlite3', 'concurrent.futures')
+    # Cumulative import time of downloader module, in microseconds
+    budget = 100000
+
+    def get_import_times(self, *args):
+        '''Run interpreter with -X importtime, return cumulative import time
+        of every imported module'''
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', *args], cwd=self.directory,
+            capture_output=True, text=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            match = re.match(r'^import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)$', line)
+            if match:
+                times[match.group(3)] = int(match.group(1))
+        return times
+
+    def test_import_budget(self):
+        '''Ensure if module is imported within budget'''
+        # The first run compiles module, the second one measures cached bytecode
+        self.get_import_times('-c', 'import downloader')
+        times = self.get_import_times('-c', 'import downloader')
+        self.assertLess(times['downloader'], self.budget)
+
+    def test_validation_paths(self):
+        '''Ensure if heavy dependencies are not imported before arguments
+        are validated'''
+        for args in (['--help'], ['-r', '1920x1080', '-m', '5'],
+                     ['-r', '1920x1080', '-m', '13', '-y', '2019'],
+                     ['-r', '19x10', '-m', '5', '-y', '2019']):
+            with self.subTest(args=args):
+                times = self.get_import_times('downloader.py', *args)
+                self.assertIn('click', times)
+                for name in self.heavy_modules:
+                    self.assertNotIn(name, times)
+
+
 if __name__ == '__main__':
     unittest.main()